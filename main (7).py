@@ -4,19 +4,54 @@
 # Features: Start, Referral, Upload (15/hour), XP, Shuffle, 👍🏻👎🏻, Comment, Save, Report
 
 import os
+import sys
 import json
+import heapq
+import bisect
+import sqlite3
+import asyncio
 import random
 import time
+import weakref
+import functools
+from collections import deque, namedtuple, OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, fields, replace
 from flask import Flask
-from threading import Thread
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton, Update
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
+from threading import Thread, Lock, Event
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton, InputMediaPhoto, Update
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+from telegram.ext import Application, BaseRateLimiter, CommandHandler, MessageHandler, CallbackQueryHandler, TypeHandler, ContextTypes, filters
 
 # ===== ENV SETUP =====
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_ID = int(os.getenv("ADMIN_ID", 8145864430))  # Amar
 DATA_FILE = "data.json"
 SETTINGS_FILE = "settings.json"
+BROADCAST_FILE = "broadcast.json"
+JOURNAL_FILE = "data.journal"
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json")  # "json" or "sqlite"
+SQLITE_FILE = os.getenv("SQLITE_FILE", "shufflegram.db")
+FLUSH_INTERVAL = float(os.getenv("FLUSH_INTERVAL", 1))  # seconds between journal fsyncs
+FLUSH_TIMEOUT = float(os.getenv("FLUSH_TIMEOUT", 10))  # give up waiting on a failing disk after this long
+COMPACT_INTERVAL = float(os.getenv("COMPACT_INTERVAL", 300))  # seconds between snapshots
+COMPACT_BYTES = int(os.getenv("COMPACT_BYTES", 4 * 1024 * 1024))  # or once the journal is this big
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", 32))  # updates processed in parallel
+SHUFFLE_QUEUE_SIZE = int(os.getenv("SHUFFLE_QUEUE_SIZE", 5))  # pre-rendered posts kept per user
+SHUFFLE_QUEUE_USERS = int(os.getenv("SHUFFLE_QUEUE_USERS", 10000))  # users with a queue in memory
+RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", 5000))  # rendered post views kept in memory
+NAME_TTL = float(os.getenv("NAME_TTL", 6 * 3600))  # seconds a resolved display name is trusted
+NAME_MISS_TTL = float(os.getenv("NAME_MISS_TTL", 3600))  # same for users the bot can't see (blocked, deleted)
+NAME_FETCHES = int(os.getenv("NAME_FETCHES", 10))  # parallel get_chat calls
+FANOUT_WORKERS = int(os.getenv("FANOUT_WORKERS", 4))  # tasks delivering new-post notifications
+EDIT_DEBOUNCE = float(os.getenv("EDIT_DEBOUNCE", 0.7))  # seconds caption edits to one message are coalesced
+DIGEST_WINDOW = float(os.getenv("DIGEST_WINDOW", 60))  # seconds comment/reply alerts are collected per recipient
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", 8))  # parallel /broadcast sends
+SEND_RATE = float(os.getenv("SEND_RATE", 25))  # messages per second across all chats (Telegram allows ~30)
+CHAT_INTERVAL = float(os.getenv("CHAT_INTERVAL", 1))  # seconds between messages to one chat, after a short burst
+DEAD_BACKOFF = float(os.getenv("DEAD_BACKOFF", 3600))  # first pause after a chat blocks the bot, doubled per failure
+DEAD_BACKOFF_MAX = float(os.getenv("DEAD_BACKOFF_MAX", 7 * 86400))
+SETTINGS_POLL_INTERVAL = float(os.getenv("SETTINGS_POLL_INTERVAL", 5))  # seconds between settings.json mtime checks
 
 # ===== FLASK KEEP-ALIVE =====
 app = Flask('')
@@ -32,76 +67,1952 @@ def keep_alive():
     t = Thread(target=run)
     t.start()
 
-# ===== DATA HANDLING =====
-def load_data():
-    if not os.path.exists(DATA_FILE):
-        with open(DATA_FILE, 'w') as f:
-            json.dump({"users": {}, "posts": {}, "reports": {}, "referrals": {}, "admins": []}, f)
-    with open(DATA_FILE, 'r') as f:
-        return json.load(f)
+# ===== METRICS =====
+# Rolling latency samples per handler / background job, reported in /stats.
+class Metrics:
+    def __init__(self, size=2000):
+        self.size = size
+        self.samples = {}
+        self.counters = {}
+
+    def record(self, name, seconds):
+        if name not in self.samples:
+            self.samples[name] = deque(maxlen=self.size)
+        self.samples[name].append(seconds)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def percentile(self, name, p):
+        samples = sorted(self.samples.get(name, ()))
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+    def report(self):
+        lines = []
+        for name in sorted(self.samples):
+            p50, p99 = self.percentile(name, 50), self.percentile(name, 99)
+            lines.append(f"{name}: p50 {p50 * 1000:.0f}ms | p99 {p99 * 1000:.0f}ms ({len(self.samples[name])})")
+        for name in sorted(self.counters):
+            lines.append(f"{name}: {self.counters[name]}")
+        presses = self.counters.get("next.presses")
+        if presses:
+            lines.append(f"next: {self.counters.get('next.api_calls', 0) / presses:.2f} API calls/press")
+        return "\n".join(lines)
+
+metrics = Metrics()
+
+def timed(handler):
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await handler(update, context)
+        finally:
+            metrics.record(handler.__name__, time.perf_counter() - started)
+    return wrapper
+
+# ===== TRANSACTIONS =====
+# The bot runs with concurrent_updates, so handlers for different users
+# interleave at every await. Updates from one user are still handled in
+# order (per_user), and check-then-write sequences that span users or posts
+# run inside `async with transaction(uid, pid)`. Locks are taken in sorted
+# key order so two transactions can never deadlock.
+class LockTable:
+    def __init__(self):
+        self.locks = weakref.WeakValueDictionary()  # unused locks drop out
+
+    def get(self, key):
+        lock = self.locks.get(key)
+        if lock is None:
+            lock = self.locks[key] = asyncio.Lock()
+        return lock
+
+locks = LockTable()
+
+@asynccontextmanager
+async def transaction(uid=None, pid=None, users=()):
+    keys = {("user", str(u)) for u in (uid, *users) if u is not None}
+    if pid is not None:
+        keys.add(("post", str(pid)))
+    held = [locks.get(key) for key in sorted(keys)]
+    acquired = []
+    try:
+        for lock in held:
+            await lock.acquire()
+            acquired.append(lock)
+        yield
+    finally:
+        for lock in reversed(acquired):
+            lock.release()
+
+def per_user(handler):
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        if update.effective_user is None:
+            return await handler(update, context)
+        async with locks.get(("update", update.effective_user.id)):
+            return await handler(update, context)
+    return wrapper
+
+# ===== DATA STORE =====
+# data.json is read once at startup and kept in memory. Every change goes
+# through store.apply(), which updates the shared dict and queues a small
+# record for data.journal. A dedicated writer thread appends and fsyncs the
+# queued records in batches every FLUSH_INTERVAL seconds, and periodically
+# folds the journal into a new data.json snapshot. Startup replays
+# snapshot + journal. Handlers that must not reply before their change is
+# on disk can `await store.flush()`, which gives up after FLUSH_TIMEOUT.
+class DataStore:
+    def __init__(self, path, journal_path):
+        self.path = path
+        self.journal_path = journal_path
+        self.data = None
+        self.seq = 0          # last journal record applied
+        self.durable_seq = 0  # last journal record fsync'd
+        self.pending = []     # (seq, journal line) not yet written
+        self.snapshot_parts = None  # latest requested snapshot, older ones are dropped
+        self.journal_bytes = 0
+        self.last_compact = time.time()
+        self.dirty = set()    # (section, key) pairs, key None = whole section
+        self.encoded = {}     # section -> {key: json text} or json text
+        self.lock = Lock()
+        self.wake = Event()
+        self.waiters = []     # (seq, future) resolved once durable_seq >= seq
+        self.loop = None
+        self.thread = None
+        self.running = False
+
+    def load(self):
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                self.data = json.load(f)
+        else:
+            self.data = {"users": {}, "posts": {}, "reports": {}, "referrals": {}, "admins": []}
+        self.seq = self.data.pop('journal_seq', 0)
+        for section in self.data:
+            self.mark(section)
+        if self.replay():
+            self.rewrite([], self.snapshot())
+        self.durable_seq = self.seq
+        return self.data
+
+    def replay(self):
+        if not os.path.exists(self.journal_path):
+            return 0
+        count = 0
+        with open(self.journal_path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break  # torn write from a crash mid-append
+                seq, op = record.pop('seq'), record.pop('op')
+                if seq <= self.seq:
+                    continue
+                MUTATIONS[op](self, **record)
+                self.seq = seq
+                count += 1
+        return count
+
+    def apply(self, op, **args):
+        result = MUTATIONS[op](self, **args)
+        self.seq += 1
+        line = json.dumps({"seq": self.seq, "op": op, **args})
+        with self.lock:
+            self.pending.append((self.seq, line))
+        return result
+
+    def mark(self, section, key=None):
+        self.dirty.add((section, key))
+
+    def _encode(self, section, key):
+        value = self.data.get(section)
+        records = self.encoded.get(section)
+        if key is None or not isinstance(value, dict) or not isinstance(records, dict):
+            if value is None:
+                self.encoded.pop(section, None)
+            elif isinstance(value, dict):
+                self.encoded[section] = {k: json.dumps(v) for k, v in value.items()}
+            else:
+                self.encoded[section] = json.dumps(value)
+        elif key in value:
+            records[key] = json.dumps(value[key])
+        else:
+            records.pop(key, None)
+
+    def snapshot(self):
+        # Runs on the event loop: cost is proportional to the dirty records only
+        for section, key in sorted(self.dirty, key=lambda d: d[1] is not None):
+            self._encode(section, key)
+        self.dirty.clear()
+        parts = {s: dict(v) if isinstance(v, dict) else v for s, v in self.encoded.items()}
+        parts['journal_seq'] = json.dumps(self.seq)
+        return parts
+
+    def write(self, parts):
+        # Assemble one record per line, then swap the file in atomically
+        sections = []
+        for section, value in parts.items():
+            if isinstance(value, dict):
+                rows = ",\n".join(f"    {json.dumps(k)}: {v}" for k, v in value.items())
+                value = "{\n" + rows + "\n  }" if rows else "{}"
+            sections.append(f"  {json.dumps(section)}: {value}")
+        tmp = self.path + ".tmp"
+        with open(tmp, 'w') as f:
+            f.write("{\n" + ",\n".join(sections) + "\n}\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def append(self, lines):
+        with open(self.journal_path, 'a') as f:
+            f.write("".join(line + "\n" for line in lines))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def rewrite(self, lines, parts):
+        # Journal first, then the snapshot that covers it, then drop the journal.
+        # A crash in between is harmless: replay skips records <= journal_seq.
+        if lines:
+            self.append(lines)
+        self.write(parts)
+        open(self.journal_path, 'w').close()
+
+    # --- writer thread ---
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.running = True
+        self.thread = Thread(target=self._writer, name="datastore-writer", daemon=True)
+        self.thread.start()
+
+    def _writer(self):
+        while self.running:
+            self.wake.wait(FLUSH_INTERVAL)
+            self.wake.clear()
+            try:
+                self._persist()
+            except Exception as e:
+                print(f"Failed to persist {self.path}: {e}")
+
+    def _persist(self):
+        # Everything queued since the last pass is written in one go, so bursts
+        # of saves coalesce into a single fsync / a single snapshot. Whatever
+        # fails to reach the disk is put back for the next pass, and only
+        # written records count as durable.
+        with self.lock:
+            batch, self.pending = self.pending, []
+            parts, self.snapshot_parts = self.snapshot_parts, None
+        if not (batch or parts):
+            return
+        started = time.perf_counter()
+        durable = None
+        try:
+            if parts:
+                covered = json.loads(parts['journal_seq'])
+                self.rewrite([line for seq, line in batch if seq <= covered], parts)
+                self.journal_bytes = 0
+                batch = [(seq, line) for seq, line in batch if seq > covered]
+                parts, durable = None, covered
+            if batch:
+                lines = [line for _, line in batch]
+                self.append(lines)
+                self.journal_bytes += sum(len(line) + 1 for line in lines)
+                batch, durable = [], batch[-1][0]
+            metrics.record("persist", time.perf_counter() - started)
+        finally:
+            if batch or parts:
+                # Replay skips records it has already applied, so lines that
+                # did make it into the journal before the failure are harmless
+                with self.lock:
+                    self.pending[:0] = batch
+                    if self.snapshot_parts is None:
+                        self.snapshot_parts = parts
+            if durable is not None:
+                self.loop.call_soon_threadsafe(self._resolve, durable)
+
+    def _resolve(self, durable):
+        self.durable_seq = max(self.durable_seq, durable)
+        waiting = []
+        for seq, future in self.waiters:
+            if seq <= self.durable_seq:
+                if not future.done():
+                    future.set_result(None)
+            else:
+                waiting.append((seq, future))
+        self.waiters = waiting
+
+    async def flush(self):
+        """Wait until every change applied so far is fsync'd.
+
+        Returns False if that did not happen within FLUSH_TIMEOUT; the
+        changes stay queued and the writer keeps retrying them.
+        """
+        if self.durable_seq >= self.seq or not self.running:
+            return True
+        future = self.loop.create_future()
+        entry = (self.seq, future)
+        self.waiters.append(entry)
+        self.wake.set()
+        try:
+            await asyncio.wait_for(future, FLUSH_TIMEOUT)
+            return True
+        except asyncio.TimeoutError:
+            if entry in self.waiters:
+                self.waiters.remove(entry)
+            return False
+
+    async def compact(self):
+        parts = self.snapshot()
+        with self.lock:
+            self.snapshot_parts = parts
+        self.last_compact = time.time()
+        if self.running:
+            self.wake.set()
+            await self.flush()
+
+    async def run(self):
+        # The writer thread syncs on its own; this only schedules compaction
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            if (self.journal_bytes >= COMPACT_BYTES or
+                    time.time() - self.last_compact >= COMPACT_INTERVAL):
+                await self.compact()
+
+    async def close(self):
+        await self.compact()
+        self.running = False
+        self.wake.set()
+        await asyncio.to_thread(self.thread.join)
+        self._persist()  # anything applied while the writer was stopping
+
+store = DataStore(DATA_FILE, JOURNAL_FILE)
+
+# ===== MUTATIONS =====
+# Each mutation is applied live by store.apply() and again on journal replay,
+# so it must only depend on its arguments and the current data.
+MUTATIONS = {}
+
+def mutation(name):
+    def register(fn):
+        MUTATIONS[name] = fn
+        return fn
+    return register
+
+@mutation("new_user")
+def _new_user(store, uid):
+    if uid in store.data['users']:
+        return
+    store.data['users'][uid] = {
+        "xp": 0,
+        "uploads": [],
+        "liked": [],
+        "disliked": [],
+        "saved": [],
+        "comments": {},
+        "uploaded_at": [],
+        "is_verified": False,
+        "banned": False,
+        "shuffle_state": None,
+        "shuffled_count": 0,
+        "referrals": 0,
+        "ref_by": None,
+        "following": [],
+        "followers": [],
+        "muted_notifications": [],
+        "anonymous_receive": True,
+        "anon_conversation": None,
+        "anon_messages": [],
+        "comment_notifications": True
+    }
+    store.mark('users', uid)
+
+@mutation("set_user")
+def _set_user(store, uid, field, value):
+    store.data['users'][uid][field] = value
+    store.mark('users', uid)
+
+@mutation("referral")
+def _referral(store, uid, ref_id):
+    store.data['users'][uid]['ref_by'] = ref_id
+    store.data['users'][ref_id]['referrals'] += 1
+    store.mark('users', uid)
+    store.mark('users', ref_id)
+
+@mutation("upload")
+def _upload(store, uid, pid, file_id, ts):
+    user = store.data['users'][uid]
+    seq = store.data.get('post_seq', 0)
+    store.data['post_seq'] = seq + 1
+    store.data['posts'][pid] = {
+        "seq": seq,
+        "file_id": file_id,
+        "uploader": uid,
+        "likes": 0,
+        "dislikes": 0,
+        "comments": [],
+        "timestamp": ts,
+        "saved_by": [],
+        "reported_by": []
+    }
+    if pid not in user['uploads']:
+        user['uploads'].append(pid)
+    user['uploaded_at'] = [t for t in user.get('uploaded_at', []) if ts - t < 3600] + [ts]
+    _grant_xp(store, uid, 5, ts)
+    store.mark('posts', pid)
+    store.mark('post_seq')
+    return seq
+
+@mutation("upload_many")
+def _upload_many(store, uid, items, ts):
+    return [_upload(store, uid, pid, file_id, ts) for pid, file_id in items]
+
+@mutation("dedupe_uploads")
+def _dedupe_uploads(store):
+    # Photos uploaded in the same second used to share a post id, leaving
+    # repeated entries in the uploader's list
+    for uid, user in store.data['users'].items():
+        uploads = list(dict.fromkeys(user['uploads']))
+        if len(uploads) != len(user['uploads']):
+            user['uploads'] = uploads
+            store.mark('users', uid)
+
+@mutation("shuffled")
+def _shuffled(store, uid, pid, state=None):
+    user = store.data['users'][uid]
+    if state is None:  # journal written before shuffle cursors
+        user['shuffled'] = (user.get('shuffled', []) + [pid])[-1000:]
+    else:
+        user['shuffle_state'] = state
+    user['shuffled_count'] = user.get('shuffled_count', 0) + 1
+    store.mark('users', uid)
+
+@mutation("migrate_shuffle")
+def _migrate_shuffle(store):
+    # Number existing posts in upload order and carry old seen-list sizes
+    # over to shuffled_count, which the shuffle limit now uses
+    posts = store.data['posts']
+    for seq, pid in enumerate(sorted(posts, key=lambda p: (posts[p]['timestamp'], p))):
+        posts[pid]['seq'] = seq
+        store.mark('posts', pid)
+    store.data['post_seq'] = len(posts)
+    store.mark('post_seq')
+    for uid, user in store.data['users'].items():
+        user['shuffled_count'] = max(user.get('shuffled_count', 0), len(user.get('shuffled', [])))
+        store.mark('users', uid)
+
+def _grant_xp(store, uid, amount, ts):
+    store.data['users'][uid]['xp'] += amount
+    store.mark('users', uid)
+    if ts is None:
+        return  # journal written before the XP ledger
+    ledger = store.data.setdefault('xp_ledger', {})
+    for kind, start in xp_buckets(ts):
+        key = f"{kind}{start}"
+        if key not in ledger:
+            for old in [k for k in ledger if k[0] == kind and int(k[1:]) <= ts - XP_RETENTION[kind]]:
+                del ledger[old]
+                store.mark('xp_ledger', old)
+            ledger[key] = {}
+        ledger[key][uid] = ledger[key].get(uid, 0) + amount
+        store.mark('xp_ledger', key)
+
+def _vote(store, uid, pid, counter, history, ts):
+    post = store.data['posts'].get(pid)
+    user = store.data['users'][uid]
+    if not post or pid in user[history]:
+        return False
+    post[counter] += 1
+    user[history].append(pid)
+    if history == 'liked':
+        _grant_xp(store, uid, 1, ts)
+    # Give uploader +2 XP
+    uploader_id = post['uploader']
+    if uploader_id in store.data['users']:
+        _grant_xp(store, uploader_id, 2, ts)
+    store.mark('posts', pid)
+    store.mark('users', uid)
+    return True
+
+@mutation("like")
+def _like(store, uid, pid, ts=None):
+    return _vote(store, uid, pid, 'likes', 'liked', ts)
+
+@mutation("dislike")
+def _dislike(store, uid, pid, ts=None):
+    return _vote(store, uid, pid, 'dislikes', 'disliked', ts)
+
+@mutation("trend")
+def _trend(store, pid, score, ts):
+    post = store.data['posts'].get(pid)
+    if post:
+        post['trend'] = [score, ts]
+        store.mark('posts', pid)
+
+@mutation("save")
+def _save(store, uid, pid):
+    if pid in store.data['users'][uid]['saved']:
+        return False
+    store.data['users'][uid]['saved'].append(pid)
+    store.mark('users', uid)
+    return True
+
+@mutation("comment")
+def _comment(store, uid, pid, text, ts):
+    post = store.data['posts'][pid]
+    post['comments'].append({"user": uid, "text": text, "timestamp": ts, "replies": []})
+    _grant_xp(store, uid, 1, ts)
+    store.mark('posts', pid)
+    return len(post['comments'])
+
+@mutation("reply")
+def _reply(store, uid, pid, idx, text, ts):
+    store.data['posts'][pid]['comments'][idx]['replies'].append({"user": uid, "text": text, "timestamp": ts})
+    store.mark('posts', pid)
+
+@mutation("report")
+def _report(store, uid, pid):
+    post = store.data['posts'][pid]
+    if uid not in post['reported_by']:
+        post['reported_by'].append(uid)
+        store.mark('posts', pid)
+    return len(post['reported_by'])
+
+@mutation("delete_post")
+def _delete_post(store, pid):
+    post = store.data['posts'].pop(pid, None)
+    if not post:
+        return
+    uploader = store.data['users'].get(post['uploader'])
+    if uploader and pid in uploader['uploads']:
+        uploader['uploads'] = [p for p in uploader['uploads'] if p != pid]
+        store.mark('users', post['uploader'])
+    store.mark('posts', pid)
+
+@mutation("ban")
+def _ban(store, uid):
+    # Remove all posts by this user
+    posts_to_remove = [pid for pid, post in store.data['posts'].items() if post['uploader'] == uid]
+    for pid in posts_to_remove:
+        del store.data['posts'][pid]
+        store.mark('posts', pid)
+    store.data['users'][uid]['banned'] = True
+    store.data['users'][uid]['uploads'] = []
+    store.mark('users', uid)
+    return posts_to_remove
+
+@mutation("follow")
+def _follow(store, uid, target):
+    if target in store.data['users'][uid]['following']:
+        return False
+    store.data['users'][uid]['following'].append(target)
+    store.data['users'][target]['followers'].append(uid)
+    store.mark('users', uid)
+    store.mark('users', target)
+    return True
+
+@mutation("mute")
+def _mute(store, uid, target):
+    if target in store.data['users'][uid].get('muted_notifications', []):
+        return False
+    store.data['users'][uid].setdefault('muted_notifications', []).append(target)
+    store.mark('users', uid)
+    return True
+
+@mutation("add_admin")
+def _add_admin(store, uid):
+    admins = store.data.setdefault('admins', [])
+    if uid in admins:
+        return False
+    admins.append(uid)
+    store.mark('admins')
+    return True
+
+@mutation("anon_message")
+def _anon_message(store, sender, to, text, ts):
+    messages = store.data.get('anon_messages')
+    if not isinstance(messages, list):
+        messages = []
+    messages.append({'from': sender, 'to': to, 'message': text, 'timestamp': ts})
+    # Clean old messages (older than 1 day)
+    store.data['anon_messages'] = [msg for msg in messages if msg['timestamp'] > ts - 86400]
+    store.mark('anon_messages')
+
+# ===== ROLES =====
+# Admin and verified flags are checked several times per update, so they
+# live in sets kept in step with the repository writes that change them.
+class RoleRegistry:
+    def __init__(self, main_admin):
+        self.main_admin = str(main_admin)
+        self.admins = set()
+        self.verified = set()
+
+    def load(self, admins, verified):
+        self.admins = set(admins)
+        self.verified = set(verified)
+
+    def is_admin(self, uid):
+        uid = str(uid)
+        return uid == self.main_admin or uid in self.admins
+
+    def is_verified(self, uid):
+        return str(uid) in self.verified
+
+    def set_admin(self, uid):
+        self.admins.add(str(uid))
+
+    def set_verified(self, uid, value):
+        if value:
+            self.verified.add(str(uid))
+        else:
+            self.verified.discard(str(uid))
+
+roles = RoleRegistry(ADMIN_ID)
+
+# ===== SHUFFLE INDEX =====
+# Every post gets a dense sequence number at upload; deleted posts leave a
+# tombstone (None) in their slot. Each user walks their own keyed
+# pseudo-random permutation of those slots, so "Next" is a cursor advance
+# and per-user state is a key plus a few (base, size, cursor) laps instead
+# of a list of seen post IDs. Posts uploaded after the lap started join a
+# "fresh" range walked in upload order (a range that can grow without
+# reshuffling anything); draws pick between the lap and the fresh range
+# weighted by what is left, so new posts mix in with old ones. When the lap
+# is done, the fresh range becomes the next lap, so the state stays a fixed
+# handful of integers however many posts arrive mid-lap.
+FEISTEL_ROUNDS = 4
+
+def permute(key, i, n):
+    """Keyed bijection on range(n): a balanced Feistel network over the
+    next even power of two, cycle-walking until the result lands below n."""
+    bits = max(2, (n - 1).bit_length())
+    bits += bits & 1
+    half = bits // 2
+    mask = (1 << half) - 1
+    x = i
+    while True:
+        left, right = x >> half, x & mask
+        for r in range(FEISTEL_ROUNDS):
+            f = ((right ^ key ^ (r * 0x9E3779B9)) * 0x85EBCA6B) & 0xFFFFFFFF
+            f ^= f >> 13
+            left, right = right, left ^ (f & mask)
+        x = (left << half) | right
+        if x < n:
+            return x
+
+class ShuffleIndex:
+    def __init__(self):
+        self.slots = []   # seq -> post ID, None once deleted
+        self.seq_of = {}  # post ID -> seq
+        self.seen = {}    # uid -> (liked/disliked/own set, legacy shuffled set)
+        self.loader = None
+
+    def load(self, posts, loader):
+        self.slots = []
+        self.seq_of = {}
+        for seq, pid in posts:
+            self.add(seq, pid)
+        self.seen = {}
+        self.loader = loader
+
+    def add(self, seq, pid):
+        if seq >= len(self.slots):
+            self.slots.extend([None] * (seq + 1 - len(self.slots)))
+        self.slots[seq] = pid
+        self.seq_of[pid] = seq
+
+    def remove(self, pid):
+        seq = self.seq_of.pop(pid, None)
+        if seq is not None:
+            self.slots[seq] = None
+            rank_index.remove(seq)
+
+    def exclusions(self, uid):
+        if uid not in self.seen:
+            permanent, legacy = self.loader(uid)
+            self.seen[uid] = (set(permanent), set(legacy))
+        return self.seen[uid]
+
+    def exclude(self, uid, pid):
+        if uid in self.seen:
+            self.seen[uid][0].add(pid)
+
+    def forget(self, uid):
+        self.seen.pop(uid, None)
+
+    def draw(self, uid, state):
+        """Return (post ID or None, new state). The caller persists the state."""
+        permanent, legacy = self.exclusions(uid)
+        if state:
+            state = dict(state, laps=[list(lap) for lap in state['laps']])
+        else:
+            state = {"key": random.getrandbits(32), "covered": 0, "laps": [], "fresh": 0}
+        laps = state['laps']  # states saved before the fresh range may hold several
+        state.setdefault('fresh', state['covered'])  # next unseen seq of [fresh, covered)
+        state['covered'] = max(state['covered'], len(self.slots))
+        while True:
+            if not laps and state['fresh'] < state['covered']:
+                laps.append([state['fresh'], state['covered'] - state['fresh'], 0])
+                state['fresh'] = state['covered']
+            fresh = state['covered'] - state['fresh']
+            left = sum(size - cursor for _, size, cursor in laps)
+            if not left:
+                return None, state
+            pick = random.randrange(left + fresh)
+            if pick >= left:
+                seq = state['fresh']
+                state['fresh'] += 1
+            else:
+                for lap in laps:
+                    pick -= lap[1] - lap[2]
+                    if pick < 0:
+                        break
+                base, size, cursor = lap
+                seq = base + permute(state['key'] ^ base, cursor, size)
+                lap[2] += 1
+                if lap[2] == size:
+                    laps.remove(lap)
+            pid = self.slots[seq]
+            if pid is not None and pid not in permanent and pid not in legacy:
+                return pid, state
+
+shuffle_index = ShuffleIndex()
+
+# ===== RANKED SHUFFLE =====
+# Ranked mode samples posts in proportion to a score built from likes,
+# dislikes, reports and age. Weights live in a Fenwick tree indexed by post
+# seq, so a vote is an O(log n) point update and a draw is an O(log n)
+# prefix search. Recency is applied as growth instead of decay: a post's
+# weight is multiplied by 2^((timestamp - epoch) / half_life) once, which
+# keeps every ratio between posts identical to decaying all of them.
+RANKED_RECENT = 100  # seqs remembered per user to avoid immediate repeats
+RANKED_TRIES = 16    # weighted probes before falling back to the cursor
+
+class Fenwick:
+    def __init__(self, values=()):
+        self.build(list(values))
+
+    def build(self, values):
+        self.values = values
+        self.n = len(values)
+        self.tree = [0.0] + values
+        for i in range(1, self.n + 1):
+            j = i + (i & -i)
+            if j <= self.n:
+                self.tree[j] += self.tree[i]
+        self.total = sum(values)
+
+    def set(self, i, value):
+        delta = value - self.values[i]
+        self.values[i] = value
+        self.total += delta
+        i += 1
+        while i <= self.n:
+            self.tree[i] += delta
+            i += i & -i
+
+    def find(self, target):
+        """Smallest index whose prefix sum exceeds target."""
+        pos, step = 0, 1 << self.n.bit_length()
+        while step:
+            if pos + step <= self.n and self.tree[pos + step] <= target:
+                pos += step
+                target -= self.tree[pos]
+            step >>= 1
+        return min(pos, self.n - 1)
+
+def rank_params(settings):
+    return (settings.like_weight, settings.dislike_weight,
+            settings.recency_half_life, settings.report_penalty)
+
+class RankIndex:
+    def __init__(self):
+        self.stats = []   # seq -> (likes, dislikes, reports, timestamp), None once deleted
+        self.tree = Fenwick()
+        self.params = None
+        self.epoch = 0
+
+    def load(self, items):
+        self.stats = []
+        for seq, stats in items:
+            self.set(seq, *stats)
+        self.params = None  # built on first draw
+
+    def weight(self, stats):
+        if stats is None:
+            return 0.0
+        like_w, dislike_w, half_life, penalty = self.params
+        likes, dislikes, reports, ts = stats
+        score = max(0.1, 1 + like_w * likes - dislike_w * dislikes) * penalty ** reports
+        return score * 2 ** ((ts - self.epoch) / (half_life * 3600))
+
+    def rebuild(self, params):
+        self.params = params
+        self.epoch = max((s[3] for s in self.stats if s), default=0)
+        size = max(16, len(self.stats) * 2)
+        self.tree.build([self.weight(s) for s in self.stats] + [0.0] * (size - len(self.stats)))
+
+    def set(self, seq, likes, dislikes, reports, ts):
+        if seq >= len(self.stats):
+            self.stats.extend([None] * (seq + 1 - len(self.stats)))
+        self.stats[seq] = (likes, dislikes, reports, ts)
+        if self.params is None:
+            return
+        # Rebase before 2^x overflows, grow the tree before it runs out of room
+        if (ts - self.epoch) / (self.params[2] * 3600) > 500 or seq >= self.tree.n:
+            self.rebuild(self.params)
+        else:
+            self.tree.set(seq, self.weight(self.stats[seq]))
+
+    def remove(self, seq):
+        if seq < len(self.stats):
+            self.stats[seq] = None
+            if self.params is not None and seq < self.tree.n:
+                self.tree.set(seq, 0.0)
+
+    def sample(self):
+        params = rank_params(load_settings())
+        if params != self.params:
+            self.rebuild(params)
+        if self.tree.total <= 0:
+            return None
+        return self.tree.find(random.random() * self.tree.total)
+
+rank_index = RankIndex()
+
+def draw_ranked(uid, state):
+    """Weighted draw for ranked mode; falls back to the cursor walk."""
+    permanent, legacy = shuffle_index.exclusions(uid)
+    recent = (state or {}).get('recent', [])
+    for _ in range(RANKED_TRIES):
+        seq = rank_index.sample()
+        if seq is None:
+            break
+        pid = shuffle_index.slots[seq] if seq < len(shuffle_index.slots) else None
+        if pid is None or pid in permanent or pid in legacy or seq in recent:
+            continue
+        state = dict(state or {"key": random.getrandbits(32), "covered": 0, "laps": [], "fresh": 0})
+        state['recent'] = (recent + [seq])[-RANKED_RECENT:]
+        return pid, state
+    return shuffle_index.draw(uid, state)
+
+def draw_shuffle(uid, state):
+    if load_settings().ranked_shuffle:
+        return draw_ranked(uid, state)
+    return shuffle_index.draw(uid, state)
+
+# ===== TRENDING =====
+# Every vote adds +1/-1 to its post's trending score, scaled by
+# 2^((t - epoch) / half_life): the same growth-instead-of-decay trick as
+# ranked shuffle, so scores decay without ever being touched and their order
+# only changes on votes. Posts with a positive score sit in a sorted list of
+# (-score, pid): a vote is a bisect plus an O(n) list shift, a page is a
+# slice. After each vote the repositories store the post's score as of that
+# moment ("trend": [score, ts]), so restarts and half-life changes reload it
+# instead of losing the recency signal; posts never voted on since start
+# from their net likes at upload time.
+TRENDING_PAGE = 5
+
+class TrendingIndex:
+    def __init__(self):
+        self.scores = {}  # pid -> score
+        self.keys = []    # (-score, pid) for positive scores, best first
+        self.loader = None
+        self.half_life = None
+        self.epoch = 0
+
+    def load(self, loader):
+        self.loader = loader  # () -> iterable of (pid, score, as-of timestamp)
+        self.half_life = None  # built on first use
+
+    def growth(self, ts):
+        return 2 ** ((ts - self.epoch) / (self.half_life * 3600))
+
+    def rebuild(self, half_life):
+        items = list(self.loader())
+        self.half_life = half_life
+        self.epoch = max((ts for _, _, ts in items), default=0)
+        self.scores = {pid: net * self.growth(ts) for pid, net, ts in items}
+        self.keys = sorted((-score, pid) for pid, score in self.scores.items() if score > 0)
+
+    def rebase(self, ts):
+        # Move the epoch forward before 2^x overflows; ratios are unchanged
+        scale = 2 ** ((self.epoch - ts) / (self.half_life * 3600))
+        self.epoch = ts
+        # Rebuilt from the scores so posts that underflowed to 0 leave the ranking
+        self.scores = {pid: score * scale for pid, score in self.scores.items() if score * scale != 0}
+        self.keys = sorted((-score, pid) for pid, score in self.scores.items() if score > 0)
+
+    def check(self):
+        half_life = load_settings().trending_half_life
+        if half_life != self.half_life:
+            self.rebuild(half_life)
+
+    def _set(self, pid, score):
+        old = self.scores.get(pid, 0)
+        if old > 0:
+            del self.keys[bisect.bisect_left(self.keys, (-old, pid))]
+        if score > 0:
+            bisect.insort(self.keys, (-score, pid))
+        self.scores[pid] = score
+
+    def vote(self, pid, weight, ts):
+        """Apply a vote; returns the post's score as of ts, for persisting."""
+        self.check()
+        if (ts - self.epoch) / (self.half_life * 3600) > 500:
+            self.rebase(ts)
+        self._set(pid, self.scores.get(pid, 0) + weight * self.growth(ts))
+        return self.scores[pid] / self.growth(ts)
+
+    def remove(self, pid):
+        if self.half_life is not None:
+            self._set(pid, 0)
+            self.scores.pop(pid, None)
+
+    def page(self, offset, limit):
+        """(post IDs at offset, total number of trending posts)"""
+        self.check()
+        return [pid for _, pid in self.keys[offset:offset + limit]], len(self.keys)
+
+trending_index = TrendingIndex()
+
+# ===== XP LEADERBOARD =====
+# Users ordered by XP, kept current by the repositories on every XP change.
+# Entries are (-xp, uid) in a sorted list: top-K is a slice and a user's rank
+# is a single bisect.
+class Leaderboard:
+    def __init__(self):
+        self.keys = []
+        self.xp = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def load(self, items):
+        self.xp = dict(items)
+        self.keys = sorted((-xp, uid) for uid, xp in self.xp.items())
+
+    def set(self, uid, xp):
+        old = self.xp.get(uid)
+        if old == xp:
+            return
+        if old is not None:
+            del self.keys[bisect.bisect_left(self.keys, (-old, uid))]
+        self.xp[uid] = xp
+        bisect.insort(self.keys, (-xp, uid))
+
+    def top(self, limit):
+        return [(uid, -xp) for xp, uid in self.keys[:limit]]
+
+    def rank(self, uid):
+        """1-based rank; users with equal XP share a rank."""
+        if uid not in self.xp:
+            return None
+        return bisect.bisect_left(self.keys, (-self.xp[uid],)) + 1
+
+xp_board = Leaderboard()
+
+# ===== XP LEDGER =====
+# Every XP grant is also added to the user's hourly and daily bucket, so
+# "XP gained since" boards sum a few buckets instead of rescanning uploads,
+# votes and comments. Hourly buckets are kept two days, daily ones 35 days.
+XP_HOUR, XP_DAY = 3600, 86400
+XP_RETENTION = {"h": 2 * XP_DAY, "d": 35 * XP_DAY}
+
+def xp_buckets(ts):
+    return [("h", int(ts // XP_HOUR * XP_HOUR)), ("d", int(ts // XP_DAY * XP_DAY))]
+
+def xp_ledger_span(since, now):
+    """Buckets covering [since, now]: hours up to the first midnight, whole days after."""
+    spans = []
+    start = int(since // XP_HOUR * XP_HOUR)
+    while start % XP_DAY and start <= now:
+        spans.append(("h", start))
+        start += XP_HOUR
+    while start <= now:
+        spans.append(("d", start))
+        start += XP_DAY
+    return spans
+
+# ===== REPOSITORY =====
+# Handlers read and write through `repo` instead of indexing the data dict.
+# Records are returned as plain dicts in the data.json layout and must be
+# treated as read-only; every change goes through a repository method.
+# STORAGE_BACKEND=json (default) keeps data.json + journal, =sqlite uses
+# indexed tables in SQLITE_FILE (import once with --import-json).
+class JsonRepository:
+    def __init__(self, store):
+        self.store = store
+        self.task = None
+        self.user_ids = []  # uids in join order, for user_page; users are never removed
+
+    def load(self):
+        self.store.load()
+        self.user_ids = list(self.store.data['users'])
+        if 'post_seq' not in self.store.data:
+            self.store.apply("migrate_shuffle")
+        if any(len(set(user['uploads'])) != len(user['uploads']) for _, user in self.users()):
+            self.store.apply("dedupe_uploads")
+        roles.load(self.store.data.get('admins', []),
+                   [uid for uid, user in self.users() if user.get('is_verified')])
+        shuffle_index.load(((post['seq'], pid) for pid, post in self.posts()), self.shuffle_history)
+        rank_index.load((post['seq'], self._rank_stats(post)) for pid, post in self.posts())
+        xp_board.load((uid, user['xp']) for uid, user in self.users())
+        trending_index.load(lambda: ((pid, *post.get('trend', (post['likes'] - post['dislikes'], post['timestamp'])))
+                                     for pid, post in self.posts()))
+
+    async def start(self):
+        self.store.start()
+        self.task = asyncio.create_task(self.store.run())
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+        await self.store.close()
+
+    async def flush(self):
+        return await self.store.flush()
+
+    # --- reads ---
+    def user(self, uid):
+        return self.store.data['users'].get(uid)
+
+    def post(self, pid):
+        return self.store.data['posts'].get(pid)
+
+    def users(self):
+        return self.store.data['users'].items()
+
+    def user_count(self):
+        return len(self.store.data['users'])
+
+    def user_page(self, cursor, limit):
+        """Up to `limit` (cursor, uid) pairs after `cursor`, in a stable order;
+        each cursor resumes right after its user."""
+        return [(cursor + i + 1, uid) for i, uid in enumerate(self.user_ids[cursor:cursor + limit])]
+
+    def posts(self):
+        return self.store.data['posts'].items()
+
+    def admins(self):
+        return list(self.store.data.get('admins', []))
+
+    def posts_by_uploader(self, uid):
+        posts = self.store.data['posts']
+        uploads = (self.user(uid) or {}).get('uploads', [])
+        return [(pid, posts[pid]) for pid in dict.fromkeys(uploads) if pid in posts]
+
+    def saved_posts(self, uid, offset, limit):
+        posts = self.store.data['posts']
+        saved = [pid for pid in (self.user(uid) or {}).get('saved', []) if pid in posts]
+        return [(pid, posts[pid]) for pid in saved[offset:offset + limit]], len(saved)
+
+    def trending_posts(self, offset, limit):
+        pids, total = trending_index.page(offset, limit)
+        posts = [(pid, self.post(pid)) for pid in pids]
+        return [(pid, post) for pid, post in posts if post], total
+
+    def reported_posts(self):
+        reported = [(pid, len(post['reported_by'])) for pid, post in self.store.data['posts'].items() if post['reported_by']]
+        reported.sort(key=lambda x: x[1], reverse=True)
+        return reported
+
+    def uploader_of_file(self, file_id):
+        for post in self.store.data['posts'].values():
+            if post['file_id'] == file_id:
+                return post['uploader']
+        return None
+
+    def comments_since(self, uid, ts):
+        result = []
+        for pid, post in self.posts_by_uploader(uid):
+            comments = [c for c in post.get('comments', []) if c.get('timestamp', 0) >= ts]
+            if comments:
+                result.append((pid, post, comments))
+        return result
+
+    def top_users(self, limit):
+        return xp_board.top(limit)
+
+    def top_xp_gains(self, since, now, limit):
+        ledger = self.store.data.get('xp_ledger', {})
+        gains = {}
+        for kind, start in xp_ledger_span(since, now):
+            for uid, xp in ledger.get(f"{kind}{start}", {}).items():
+                gains[uid] = gains.get(uid, 0) + xp
+        return heapq.nlargest(limit, gains.items(), key=lambda x: x[1])
+
+    def shuffle_history(self, uid):
+        user = self.user(uid) or {}
+        # Liked/disliked and own posts are never shown, nor is the pre-cursor seen list
+        return user.get("liked", []) + user.get("disliked", []) + user.get("uploads", []), user.get("shuffled", [])
+
+    def _rank_stats(self, post):
+        return post['likes'], post['dislikes'], len(post['reported_by']), post['timestamp']
+
+    def _rank(self, pid):
+        post = self.post(pid)
+        if post:
+            rank_index.set(post['seq'], *self._rank_stats(post))
+
+    def shuffle_state(self, uid):
+        return (self.user(uid) or {}).get('shuffle_state')
+
+    def anon_candidates(self, uid):
+        return [user_id for user_id, user_data in self.users()
+                if user_id != uid and user_data.get('anonymous_receive', True) and not user_data.get('anon_conversation')]
+
+    def anon_inbox(self, uid):
+        messages = self.store.data.get('anon_messages')
+        return [msg for msg in messages if msg['to'] == uid] if isinstance(messages, list) else []
+
+    def stats(self, now):
+        users = self.store.data['users'].values()
+        return {
+            "total_users": len(self.store.data['users']),
+            "total_posts": len(self.store.data['posts']),
+            "total_uploads": sum(len(user.get('uploads', [])) for user in users),
+            "verified_users": sum(1 for user in users if user.get('is_verified', False)),
+            "banned_users": sum(1 for user in users if user.get('banned', False)),
+            "recent_uploads": sum(len([t for t in user.get('uploaded_at', []) if now - t < 86400]) for user in users),
+            "active_users": sum(1 for user in users if any(now - t < 86400 for t in user.get('uploaded_at', []))),
+            "reported_posts": len(self.reported_posts()),
+        }
 
-def save_data(data):
-    with open(DATA_FILE, 'w') as f:
-        json.dump(data, f, indent=2)
+    # --- writes: each one is a journaled mutation ---
+    def ensure_user(self, uid):
+        if uid not in self.store.data['users']:
+            self.store.apply("new_user", uid=uid)
+            self.user_ids.append(uid)
+            xp_board.set(uid, 0)
+        return self.store.data['users'][uid]
+
+    def _touch_user(self, uid):
+        user = self.user(uid)
+        render_cache.touch_user(uid)
+        if user:
+            xp_board.set(uid, user['xp'])
+
+    def set_user(self, uid, field, value):
+        self.store.apply("set_user", uid=uid, field=field, value=value)
+        self._touch_user(uid)
+        if field == 'is_verified':
+            roles.set_verified(uid, value)
+
+    def referral(self, uid, ref_id):
+        self.store.apply("referral", uid=uid, ref_id=ref_id)
+
+    def upload(self, uid, pid, file_id, ts):
+        self.upload_many(uid, [(pid, file_id)], ts)
+
+    def upload_many(self, uid, items, ts):
+        """Add several (pid, file_id) posts by uid as one write."""
+        seqs = self.store.apply("upload_many", uid=uid, items=items, ts=ts)
+        self._touch_user(uid)
+        for seq, (pid, _) in zip(seqs, items):
+            shuffle_index.add(seq, pid)
+            shuffle_index.exclude(uid, pid)
+            self._rank(pid)
+
+    def shuffled(self, uid, pid, state):
+        self.store.apply("shuffled", uid=uid, pid=pid, state=state)
+
+    def _touch_vote(self, uid, pid):
+        post = self.post(pid)
+        render_cache.touch_post(pid)
+        self._touch_user(uid)
+        if post:
+            self._touch_user(post['uploader'])
 
-def load_settings():
-    if not os.path.exists(SETTINGS_FILE):
-        default_settings = {
-            "referral_system": False,
-            "upload_limit": 15,
-            "shuffle_limit": 20,
-            "comment_notifications": True
+    def like(self, uid, pid):
+        shuffle_index.exclude(uid, pid)
+        now = time.time()
+        liked = self.store.apply("like", uid=uid, pid=pid, ts=now)
+        self._touch_vote(uid, pid)
+        self._rank(pid)
+        if liked:
+            self.store.apply("trend", pid=pid, score=trending_index.vote(pid, 1, now), ts=now)
+        return liked
+
+    def dislike(self, uid, pid):
+        shuffle_index.exclude(uid, pid)
+        now = time.time()
+        disliked = self.store.apply("dislike", uid=uid, pid=pid, ts=now)
+        self._touch_vote(uid, pid)
+        self._rank(pid)
+        if disliked:
+            self.store.apply("trend", pid=pid, score=trending_index.vote(pid, -1, now), ts=now)
+        return disliked
+
+    def save(self, uid, pid):
+        return self.store.apply("save", uid=uid, pid=pid)
+
+    def comment(self, uid, pid, text, ts):
+        count = self.store.apply("comment", uid=uid, pid=pid, text=text, ts=ts)
+        render_cache.touch_post(pid)
+        self._touch_user(uid)
+        return count
+
+    def reply(self, uid, pid, idx, text, ts):
+        self.store.apply("reply", uid=uid, pid=pid, idx=idx, text=text, ts=ts)
+
+    def report(self, uid, pid):
+        shuffle_index.exclude(uid, pid)
+        count = self.store.apply("report", uid=uid, pid=pid)
+        self._rank(pid)
+        return count
+
+    def delete_post(self, pid):
+        self.store.apply("delete_post", pid=pid)
+        shuffle_index.remove(pid)
+        trending_index.remove(pid)
+
+    def ban(self, uid):
+        removed = self.store.apply("ban", uid=uid)
+        for pid in removed:
+            shuffle_index.remove(pid)
+            trending_index.remove(pid)
+        return removed
+
+    def follow(self, uid, target):
+        return self.store.apply("follow", uid=uid, target=target)
+
+    def mute(self, uid, target):
+        return self.store.apply("mute", uid=uid, target=target)
+
+    def add_admin(self, uid):
+        roles.set_admin(uid)
+        return self.store.apply("add_admin", uid=uid)
+
+    def anon_message(self, sender, to, text, ts):
+        self.store.apply("anon_message", sender=sender, to=to, text=text, ts=ts)
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    uid TEXT PRIMARY KEY,
+    xp INTEGER NOT NULL DEFAULT 0,
+    is_verified INTEGER NOT NULL DEFAULT 0,
+    banned INTEGER NOT NULL DEFAULT 0,
+    referrals INTEGER NOT NULL DEFAULT 0,
+    ref_by TEXT,
+    anonymous_receive INTEGER NOT NULL DEFAULT 1,
+    comment_notifications INTEGER NOT NULL DEFAULT 1,
+    anon_conversation TEXT,
+    extra TEXT NOT NULL DEFAULT '{}'
+);
+CREATE INDEX IF NOT EXISTS users_xp ON users(xp DESC);
+CREATE TABLE IF NOT EXISTS posts (
+    pid TEXT PRIMARY KEY,
+    file_id TEXT NOT NULL,
+    uploader TEXT NOT NULL,
+    likes INTEGER NOT NULL DEFAULT 0,
+    dislikes INTEGER NOT NULL DEFAULT 0,
+    timestamp REAL NOT NULL,
+    seq INTEGER NOT NULL UNIQUE
+);
+CREATE INDEX IF NOT EXISTS posts_uploader ON posts(uploader, timestamp);
+CREATE INDEX IF NOT EXISTS posts_likes ON posts(likes DESC);
+CREATE INDEX IF NOT EXISTS posts_file_id ON posts(file_id);
+CREATE TABLE IF NOT EXISTS likes (
+    uid TEXT NOT NULL,
+    pid TEXT NOT NULL,
+    value INTEGER NOT NULL,
+    PRIMARY KEY (uid, pid, value)
+);
+CREATE INDEX IF NOT EXISTS likes_pid ON likes(pid);
+CREATE TABLE IF NOT EXISTS saves (
+    uid TEXT NOT NULL,
+    pid TEXT NOT NULL,
+    PRIMARY KEY (uid, pid)
+);
+CREATE INDEX IF NOT EXISTS saves_pid ON saves(pid);
+CREATE TABLE IF NOT EXISTS follows (
+    follower TEXT NOT NULL,
+    followee TEXT NOT NULL,
+    PRIMARY KEY (follower, followee)
+);
+CREATE INDEX IF NOT EXISTS follows_followee ON follows(followee);
+CREATE TABLE IF NOT EXISTS comments (
+    id INTEGER PRIMARY KEY,
+    pid TEXT NOT NULL,
+    user TEXT NOT NULL,
+    text TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    parent INTEGER
+);
+CREATE INDEX IF NOT EXISTS comments_pid ON comments(pid, timestamp);
+CREATE INDEX IF NOT EXISTS comments_parent ON comments(parent);
+CREATE TABLE IF NOT EXISTS reports (
+    pid TEXT NOT NULL,
+    uid TEXT NOT NULL,
+    PRIMARY KEY (pid, uid)
+);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO counters (name, value) VALUES ('post_seq', 0);
+CREATE TABLE IF NOT EXISTS admins (
+    uid TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS anon_messages (
+    id INTEGER PRIMARY KEY,
+    sender TEXT NOT NULL,
+    recipient TEXT NOT NULL,
+    message TEXT NOT NULL,
+    timestamp REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS anon_messages_timestamp ON anon_messages(timestamp);
+CREATE INDEX IF NOT EXISTS anon_messages_recipient ON anon_messages(recipient);
+CREATE TABLE IF NOT EXISTS trends (
+    pid TEXT PRIMARY KEY,
+    score REAL NOT NULL,
+    ts REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS xp_ledger (
+    kind TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    uid TEXT NOT NULL,
+    xp INTEGER NOT NULL,
+    PRIMARY KEY (kind, start, uid)
+);
+"""
+
+class SqliteRepository:
+    COLUMNS = ('xp', 'is_verified', 'banned', 'referrals', 'ref_by',
+               'anonymous_receive', 'comment_notifications', 'anon_conversation')
+    FLAGS = ('is_verified', 'banned', 'anonymous_receive', 'comment_notifications')
+
+    # Every per-user list in one round trip, each in its own insertion order
+    USER_LISTS_SQL = (
+        "SELECT name, item FROM ("
+        "SELECT 'uploads' AS name, pid AS item, timestamp AS pos FROM posts WHERE uploader = ?1 "
+        "UNION ALL SELECT CASE value WHEN 1 THEN 'liked' ELSE 'disliked' END, pid, rowid FROM likes WHERE uid = ?1 "
+        "UNION ALL SELECT 'saved', pid, rowid FROM saves WHERE uid = ?1 "
+        "UNION ALL SELECT 'following', followee, rowid FROM follows WHERE follower = ?1 "
+        "UNION ALL SELECT 'followers', follower, rowid FROM follows WHERE followee = ?1"
+        ") ORDER BY name, pos")
+    CHUNK = 500  # ids per IN (...) list, well under SQLite's variable limit
+
+    RANK_SQL = ("SELECT seq, likes, dislikes, (SELECT COUNT(*) FROM reports r WHERE r.pid = posts.pid), timestamp "
+                "FROM posts")
+
+    def __init__(self, path):
+        self.path = path
+        self.db = None
+        self.ledger_hour = None  # stale ledger buckets are pruned once an hour
+
+    def load(self):
+        self.db = sqlite3.connect(self.path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SQLITE_SCHEMA)
+        roles.load(self.admins(), self._column("SELECT uid FROM users WHERE is_verified = 1"))
+        shuffle_index.load(self.db.execute("SELECT seq, pid FROM posts").fetchall(), self.shuffle_history)
+        rank_index.load((row[0], tuple(row[1:])) for row in self.db.execute(self.RANK_SQL))
+        xp_board.load(self.db.execute("SELECT uid, xp FROM users"))
+        trending_index.load(lambda: self.db.execute(
+            "SELECT p.pid, COALESCE(t.score, p.likes - p.dislikes), COALESCE(t.ts, p.timestamp) "
+            "FROM posts p LEFT JOIN trends t ON t.pid = p.pid").fetchall())
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        self.db.close()
+
+    async def flush(self):
+        return True  # every write commits its own transaction
+
+    def _column(self, sql, *args):
+        return [row[0] for row in self.db.execute(sql, args)]
+
+    def _by_pid(self, sql, pids):
+        """Run `sql` over pids in IN (...) chunks and group the rows by their pid column."""
+        grouped = {}
+        for i in range(0, len(pids), self.CHUNK):
+            chunk = pids[i:i + self.CHUNK]
+            for row in self.db.execute(sql.format(",".join("?" * len(chunk))), chunk):
+                grouped.setdefault(row['pid'], []).append(row)
+        return grouped
+
+    def _posts(self, sql, *args):
+        # One query per related table for the whole list instead of per post
+        rows = self.db.execute(sql, args).fetchall()
+        pids = [row['pid'] for row in rows]
+        comments = self._by_pid("SELECT * FROM comments WHERE pid IN ({}) ORDER BY id", pids)
+        saves = self._by_pid("SELECT pid, uid FROM saves WHERE pid IN ({}) ORDER BY rowid", pids)
+        reports = self._by_pid("SELECT pid, uid FROM reports WHERE pid IN ({}) ORDER BY rowid", pids)
+        result = []
+        for row in rows:
+            pid = row['pid']
+            threads, top = {}, []
+            for c in comments.get(pid, []):
+                entry = {"user": c['user'], "text": c['text'], "timestamp": c['timestamp']}
+                if c['parent'] is None:
+                    entry['replies'] = threads[c['id']] = []
+                    top.append(entry)
+                elif c['parent'] in threads:
+                    threads[c['parent']].append(entry)
+            result.append((pid, {
+                "file_id": row['file_id'],
+                "uploader": row['uploader'],
+                "likes": row['likes'],
+                "dislikes": row['dislikes'],
+                "comments": top,
+                "timestamp": row['timestamp'],
+                "seq": row['seq'],
+                "saved_by": [r['uid'] for r in saves.get(pid, [])],
+                "reported_by": [r['uid'] for r in reports.get(pid, [])],
+            }))
+        return result
+
+    # --- reads ---
+    def user(self, uid):
+        row = self.db.execute("SELECT * FROM users WHERE uid = ?", (uid,)).fetchone()
+        if not row:
+            return None
+        user = json.loads(row['extra'])
+        for column in self.COLUMNS:
+            user[column] = bool(row[column]) if column in self.FLAGS else row[column]
+        lists = {name: [] for name in ('uploads', 'liked', 'disliked', 'saved', 'following', 'followers')}
+        for name, item in self.db.execute(self.USER_LISTS_SQL, (uid,)):
+            lists[name].append(item)
+        user.update(lists)
+        return user
+
+    def post(self, pid):
+        posts = self._posts("SELECT * FROM posts WHERE pid = ?", pid)
+        return posts[0][1] if posts else None
+
+    def users(self):
+        return [(uid, self.user(uid)) for uid in self._column("SELECT uid FROM users")]
+
+    def user_count(self):
+        return self.db.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def user_page(self, cursor, limit):
+        return [(row[0], row[1]) for row in
+                self.db.execute("SELECT rowid, uid FROM users WHERE rowid > ? ORDER BY rowid LIMIT ?", (cursor, limit))]
+
+    def posts(self):
+        return self._posts("SELECT * FROM posts")
+
+    def admins(self):
+        return self._column("SELECT uid FROM admins")
+
+    def posts_by_uploader(self, uid):
+        return self._posts("SELECT * FROM posts WHERE uploader = ? ORDER BY timestamp", uid)
+
+    def saved_posts(self, uid, offset, limit):
+        total = self.db.execute("SELECT COUNT(*) FROM saves s JOIN posts p ON p.pid = s.pid WHERE s.uid = ?",
+                                (uid,)).fetchone()[0]
+        return self._posts("SELECT p.* FROM saves s JOIN posts p ON p.pid = s.pid WHERE s.uid = ? "
+                           "ORDER BY s.rowid LIMIT ? OFFSET ?", uid, limit, offset), total
+
+    def trending_posts(self, offset, limit):
+        pids, total = trending_index.page(offset, limit)
+        if not pids:
+            return [], total
+        posts = dict(self._posts(f"SELECT * FROM posts WHERE pid IN ({','.join('?' * len(pids))})", *pids))
+        return [(pid, posts[pid]) for pid in pids if pid in posts], total
+
+    def reported_posts(self):
+        return [(row[0], row[1]) for row in self.db.execute(
+            "SELECT pid, COUNT(*) AS n FROM reports GROUP BY pid ORDER BY n DESC")]
+
+    def uploader_of_file(self, file_id):
+        row = self.db.execute("SELECT uploader FROM posts WHERE file_id = ?", (file_id,)).fetchone()
+        return row[0] if row else None
+
+    def comments_since(self, uid, ts):
+        result = []
+        for pid, post in self._posts(
+                "SELECT DISTINCT p.* FROM posts p JOIN comments c ON c.pid = p.pid "
+                "WHERE p.uploader = ? AND c.parent IS NULL AND c.timestamp >= ? ORDER BY p.timestamp", uid, ts):
+            result.append((pid, post, [c for c in post['comments'] if c['timestamp'] >= ts]))
+        return result
+
+    def top_users(self, limit):
+        return xp_board.top(limit)
+
+    def top_xp_gains(self, since, now, limit):
+        spans = xp_ledger_span(since, now)
+        if not spans:
+            return []
+        where = " OR ".join("(kind = ? AND start = ?)" for _ in spans)
+        args = [value for span in spans for value in span]
+        return [(row[0], row[1]) for row in self.db.execute(
+            f"SELECT uid, SUM(xp) AS gained FROM xp_ledger WHERE {where} GROUP BY uid ORDER BY gained DESC LIMIT ?",
+            (*args, limit))]
+
+    def _extra(self, uid):
+        row = self.db.execute("SELECT extra FROM users WHERE uid = ?", (uid,)).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def shuffle_history(self, uid):
+        return self._column("SELECT pid FROM likes WHERE uid = ? UNION SELECT pid FROM posts WHERE uploader = ?",
+                            uid, uid), self._extra(uid).get('shuffled', [])
+
+    def _rank(self, pid):
+        row = self.db.execute(self.RANK_SQL + " WHERE pid = ?", (pid,)).fetchone()
+        if row:
+            rank_index.set(*row)
+
+    def shuffle_state(self, uid):
+        return self._extra(uid).get('shuffle_state')
+
+    def anon_candidates(self, uid):
+        return self._column(
+            "SELECT uid FROM users WHERE uid != ? AND anonymous_receive = 1 AND anon_conversation IS NULL", uid)
+
+    def anon_inbox(self, uid):
+        return [{'from': row['sender'], 'to': row['recipient'], 'message': row['message'], 'timestamp': row['timestamp']}
+                for row in self.db.execute("SELECT * FROM anon_messages WHERE recipient = ? ORDER BY id", (uid,))]
+
+    def stats(self, now):
+        one = lambda sql, *args: self.db.execute(sql, args).fetchone()[0]
+        return {
+            "total_users": one("SELECT COUNT(*) FROM users"),
+            "total_posts": one("SELECT COUNT(*) FROM posts"),
+            "total_uploads": one("SELECT COUNT(*) FROM posts p JOIN users u ON u.uid = p.uploader"),
+            "verified_users": one("SELECT COUNT(*) FROM users WHERE is_verified = 1"),
+            "banned_users": one("SELECT COUNT(*) FROM users WHERE banned = 1"),
+            "recent_uploads": one("SELECT COUNT(*) FROM posts WHERE timestamp > ?", now - 86400),
+            "active_users": one("SELECT COUNT(DISTINCT uploader) FROM posts WHERE timestamp > ?", now - 86400),
+            "reported_posts": one("SELECT COUNT(DISTINCT pid) FROM reports"),
         }
-        with open(SETTINGS_FILE, 'w') as f:
-            json.dump(default_settings, f)
-        return default_settings
-    with open(SETTINGS_FILE, 'r') as f:
-        return json.load(f)
 
-def save_settings(settings):
-    with open(SETTINGS_FILE, 'w') as f:
-        json.dump(settings, f, indent=2)
+    # --- writes ---
+    def _update_extra(self, uid, fn):
+        extra = json.loads(self.db.execute("SELECT extra FROM users WHERE uid = ?", (uid,)).fetchone()[0])
+        result = fn(extra)
+        self.db.execute("UPDATE users SET extra = ? WHERE uid = ?", (json.dumps(extra), uid))
+        return result
+
+    def _add_xp(self, uid, amount, ts):
+        self.db.execute("UPDATE users SET xp = xp + ? WHERE uid = ?", (amount, uid))
+        buckets = xp_buckets(ts)
+        for kind, start in buckets:
+            self.db.execute("INSERT INTO xp_ledger (kind, start, uid, xp) VALUES (?, ?, ?, ?) "
+                            "ON CONFLICT (kind, start, uid) DO UPDATE SET xp = xp + excluded.xp",
+                            (kind, start, uid, amount))
+        if buckets[0][1] != self.ledger_hour:
+            self.ledger_hour = buckets[0][1]
+            self.db.execute("DELETE FROM xp_ledger WHERE (kind = 'h' AND start <= ?) OR (kind = 'd' AND start <= ?)",
+                            (ts - XP_RETENTION['h'], ts - XP_RETENTION['d']))
+        self._touch_user(uid)
+
+    def _touch_user(self, uid):
+        row = self.db.execute("SELECT xp FROM users WHERE uid = ?", (uid,)).fetchone()
+        render_cache.touch_user(uid)
+        if row:
+            xp_board.set(uid, row[0])
+
+    def ensure_user(self, uid):
+        with self.db:
+            if self.db.execute("INSERT OR IGNORE INTO users (uid, extra) VALUES (?, ?)", (uid, json.dumps({
+                    "comments": {}, "uploaded_at": [], "shuffle_state": None, "shuffled_count": 0,
+                    "muted_notifications": [], "anon_messages": []}))).rowcount:
+                xp_board.set(uid, 0)
+        return self.user(uid)
+
+    def set_user(self, uid, field, value):
+        with self.db:
+            if field in self.COLUMNS:
+                self.db.execute(f"UPDATE users SET {field} = ? WHERE uid = ?", (value, uid))
+            else:
+                self._update_extra(uid, lambda extra: extra.__setitem__(field, value))
+        self._touch_user(uid)
+        if field == 'is_verified':
+            roles.set_verified(uid, value)
+
+    def referral(self, uid, ref_id):
+        with self.db:
+            self.db.execute("UPDATE users SET ref_by = ? WHERE uid = ?", (ref_id, uid))
+            self.db.execute("UPDATE users SET referrals = referrals + 1 WHERE uid = ?", (ref_id,))
+
+    def upload(self, uid, pid, file_id, ts):
+        self.upload_many(uid, [(pid, file_id)], ts)
+
+    def upload_many(self, uid, items, ts):
+        def stamp(extra):
+            extra['uploaded_at'] = [t for t in extra.get('uploaded_at', []) if ts - t < 3600] + [ts] * len(items)
+        with self.db:
+            seq = self.db.execute("SELECT value FROM counters WHERE name = 'post_seq'").fetchone()[0]
+            self.db.execute("UPDATE counters SET value = ? WHERE name = 'post_seq'", (seq + len(items),))
+            self.db.executemany("INSERT INTO posts (pid, file_id, uploader, timestamp, seq) VALUES (?, ?, ?, ?, ?)",
+                                [(pid, file_id, uid, ts, seq + i) for i, (pid, file_id) in enumerate(items)])
+            self._update_extra(uid, stamp)
+            self._add_xp(uid, 5 * len(items), ts)
+        for i, (pid, _) in enumerate(items):
+            shuffle_index.add(seq + i, pid)
+            shuffle_index.exclude(uid, pid)
+            self._rank(pid)
+
+    def shuffled(self, uid, pid, state):
+        def remember(extra):
+            extra['shuffle_state'] = state
+            extra['shuffled_count'] = extra.get('shuffled_count', 0) + 1
+        with self.db:
+            self._update_extra(uid, remember)
+
+    def _vote(self, uid, pid, value, counter):
+        with self.db:
+            row = self.db.execute("SELECT uploader FROM posts WHERE pid = ?", (pid,)).fetchone()
+            if not row:
+                return False
+            if not self.db.execute("INSERT OR IGNORE INTO likes (uid, pid, value) VALUES (?, ?, ?)",
+                                   (uid, pid, value)).rowcount:
+                return False
+            self.db.execute(f"UPDATE posts SET {counter} = {counter} + 1 WHERE pid = ?", (pid,))
+            render_cache.touch_post(pid)
+            now = time.time()
+            if value > 0:
+                self._add_xp(uid, 1, now)
+            # Give uploader +2 XP
+            self._add_xp(row[0], 2, now)
+            return True
+
+    def like(self, uid, pid):
+        shuffle_index.exclude(uid, pid)
+        liked = self._vote(uid, pid, 1, 'likes')
+        self._rank(pid)
+        if liked:
+            self._trend(pid, 1)
+        return liked
+
+    def dislike(self, uid, pid):
+        shuffle_index.exclude(uid, pid)
+        disliked = self._vote(uid, pid, -1, 'dislikes')
+        self._rank(pid)
+        if disliked:
+            self._trend(pid, -1)
+        return disliked
+
+    def _trend(self, pid, weight):
+        now = time.time()
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO trends (pid, score, ts) VALUES (?, ?, ?)",
+                            (pid, trending_index.vote(pid, weight, now), now))
+
+    def save(self, uid, pid):
+        with self.db:
+            return bool(self.db.execute("INSERT OR IGNORE INTO saves (uid, pid) VALUES (?, ?)", (uid, pid)).rowcount)
+
+    def comment(self, uid, pid, text, ts):
+        with self.db:
+            self.db.execute("INSERT INTO comments (pid, user, text, timestamp) VALUES (?, ?, ?, ?)", (pid, uid, text, ts))
+            render_cache.touch_post(pid)
+            self._add_xp(uid, 1, ts)
+            return self.db.execute("SELECT COUNT(*) FROM comments WHERE pid = ? AND parent IS NULL", (pid,)).fetchone()[0]
+
+    def reply(self, uid, pid, idx, text, ts):
+        with self.db:
+            parent = self.db.execute("SELECT id FROM comments WHERE pid = ? AND parent IS NULL ORDER BY id LIMIT 1 OFFSET ?",
+                                     (pid, idx)).fetchone()
+            if parent:
+                self.db.execute("INSERT INTO comments (pid, user, text, timestamp, parent) VALUES (?, ?, ?, ?, ?)",
+                                (pid, uid, text, ts, parent[0]))
+
+    def report(self, uid, pid):
+        shuffle_index.exclude(uid, pid)
+        with self.db:
+            self.db.execute("INSERT OR IGNORE INTO reports (pid, uid) VALUES (?, ?)", (pid, uid))
+            count = self.db.execute("SELECT COUNT(*) FROM reports WHERE pid = ?", (pid,)).fetchone()[0]
+        self._rank(pid)
+        return count
+
+    def _delete_post(self, pid):
+        for table in ("posts", "likes", "saves", "reports", "comments", "trends"):
+            self.db.execute(f"DELETE FROM {table} WHERE pid = ?", (pid,))
+
+    def delete_post(self, pid):
+        with self.db:
+            self._delete_post(pid)
+        shuffle_index.remove(pid)
+        trending_index.remove(pid)
+
+    def ban(self, uid):
+        with self.db:
+            pids = self._column("SELECT pid FROM posts WHERE uploader = ?", uid)
+            for pid in pids:
+                self._delete_post(pid)
+            self.db.execute("UPDATE users SET banned = 1 WHERE uid = ?", (uid,))
+        for pid in pids:
+            shuffle_index.remove(pid)
+            trending_index.remove(pid)
+        return pids
+
+    def follow(self, uid, target):
+        with self.db:
+            return bool(self.db.execute("INSERT OR IGNORE INTO follows (follower, followee) VALUES (?, ?)",
+                                        (uid, target)).rowcount)
+
+    def mute(self, uid, target):
+        def add(extra):
+            muted = extra.setdefault('muted_notifications', [])
+            if target in muted:
+                return False
+            muted.append(target)
+            return True
+        with self.db:
+            return self._update_extra(uid, add)
+
+    def add_admin(self, uid):
+        roles.set_admin(uid)
+        with self.db:
+            return bool(self.db.execute("INSERT OR IGNORE INTO admins (uid) VALUES (?)", (uid,)).rowcount)
+
+    def anon_message(self, sender, to, text, ts):
+        with self.db:
+            self.db.execute("INSERT INTO anon_messages (sender, recipient, message, timestamp) VALUES (?, ?, ?, ?)",
+                            (sender, to, text, ts))
+            # Clean old messages (older than 1 day)
+            self.db.execute("DELETE FROM anon_messages WHERE timestamp <= ?", (ts - 86400,))
+
+def import_json_to_sqlite(db_path):
+    """One-shot copy of data.json (plus any pending journal) into a SQLite database."""
+    data = store.load()
+    if 'post_seq' not in data:
+        _migrate_shuffle(store)
+    sql = SqliteRepository(db_path)
+    sql.load()
+    # Comments and anon messages have no natural key, so a second import
+    # would duplicate them; only ever import into a fresh database
+    if sql.db.execute("SELECT EXISTS (SELECT 1 FROM users) OR EXISTS (SELECT 1 FROM posts)").fetchone()[0]:
+        print(f"Error: {db_path} already has data; import into a new database file")
+        return
+    lists = ('uploads', 'liked', 'disliked', 'saved', 'following', 'followers')
+    with sql.db:
+        for uid, user in data['users'].items():
+            extra = {k: v for k, v in user.items() if k not in SqliteRepository.COLUMNS and k not in lists}
+            sql.db.execute(
+                "INSERT OR REPLACE INTO users (uid, xp, is_verified, banned, referrals, ref_by, anonymous_receive, "
+                "comment_notifications, anon_conversation, extra) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (uid, user.get('xp', 0), bool(user.get('is_verified')), bool(user.get('banned')), user.get('referrals', 0),
+                 user.get('ref_by'), user.get('anonymous_receive', True), user.get('comment_notifications', True),
+                 user.get('anon_conversation'), json.dumps(extra)))
+        for pid, post in data['posts'].items():
+            sql.db.execute("INSERT OR REPLACE INTO posts (pid, file_id, uploader, likes, dislikes, timestamp, seq) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           (pid, post['file_id'], post['uploader'], post['likes'], post['dislikes'], post['timestamp'], post['seq']))
+            if 'trend' in post:
+                sql.db.execute("INSERT OR REPLACE INTO trends (pid, score, ts) VALUES (?, ?, ?)", (pid, *post['trend']))
+            for comment in post.get('comments', []):
+                parent = sql.db.execute("INSERT INTO comments (pid, user, text, timestamp) VALUES (?, ?, ?, ?)",
+                                        (pid, comment['user'], comment['text'], comment.get('timestamp', 0))).lastrowid
+                for reply in comment.get('replies', []):
+                    sql.db.execute("INSERT INTO comments (pid, user, text, timestamp, parent) VALUES (?, ?, ?, ?, ?)",
+                                   (pid, reply['user'], reply['text'], reply.get('timestamp', 0), parent))
+            for uid in post.get('reported_by', []):
+                sql.db.execute("INSERT OR IGNORE INTO reports (pid, uid) VALUES (?, ?)", (pid, uid))
+        for uid, user in data['users'].items():
+            for key, value in (('liked', 1), ('disliked', -1)):
+                for pid in user.get(key, []):
+                    if pid in data['posts']:
+                        sql.db.execute("INSERT OR IGNORE INTO likes (uid, pid, value) VALUES (?, ?, ?)", (uid, pid, value))
+            for pid in user.get('saved', []):
+                if pid in data['posts']:
+                    sql.db.execute("INSERT OR IGNORE INTO saves (uid, pid) VALUES (?, ?)", (uid, pid))
+            for target in user.get('following', []):
+                sql.db.execute("INSERT OR IGNORE INTO follows (follower, followee) VALUES (?, ?)", (uid, target))
+            for follower in user.get('followers', []):
+                sql.db.execute("INSERT OR IGNORE INTO follows (follower, followee) VALUES (?, ?)", (follower, uid))
+        sql.db.execute("UPDATE counters SET value = ? WHERE name = 'post_seq'", (data['post_seq'],))
+        for uid in data.get('admins', []):
+            sql.db.execute("INSERT OR IGNORE INTO admins (uid) VALUES (?)", (uid,))
+        for key, bucket in data.get('xp_ledger', {}).items():
+            for uid, xp in bucket.items():
+                sql.db.execute("INSERT OR REPLACE INTO xp_ledger (kind, start, uid, xp) VALUES (?, ?, ?, ?)",
+                               (key[0], int(key[1:]), uid, xp))
+        if isinstance(data.get('anon_messages'), list):
+            for msg in data['anon_messages']:
+                sql.db.execute("INSERT INTO anon_messages (sender, recipient, message, timestamp) VALUES (?, ?, ?, ?)",
+                               (msg['from'], msg['to'], msg['message'], msg['timestamp']))
+    print(f"Imported {len(data['users'])} users and {len(data['posts'])} posts into {db_path}")
+
+repo = SqliteRepository(SQLITE_FILE) if STORAGE_BACKEND == "sqlite" else JsonRepository(store)
+
+# ===== SETTINGS =====
+@dataclass(frozen=True)
+class Settings:
+    referral_system: bool = False
+    upload_limit: int = 15
+    shuffle_limit: int = 20
+    comment_notifications: bool = True
+    ranked_shuffle: bool = False
+    like_weight: float = 1.0
+    dislike_weight: float = 1.0
+    recency_half_life: int = 24  # hours
+    report_penalty: float = 0.5  # score multiplier per report
+    trending_half_life: int = 24  # hours
+
+    @classmethod
+    def from_dict(cls, raw):
+        known = {f.name: f.type for f in fields(cls)}
+        return cls(**{k: known[k](v) for k, v in raw.items() if k in known})
+
+    def to_dict(self):
+        return {f.name: getattr(self, f.name) for f in fields(self)}
+
+class SettingsStore:
+    """settings.json held in memory; admin edits swap in a new Settings and
+    external edits are picked up by polling the file's mtime."""
+
+    def __init__(self, path):
+        self.path = path
+        self.current = Settings()
+        self.mtime = None
+        self.task = None
+
+    def load(self):
+        if not os.path.exists(self.path):
+            self.write(Settings())
+            return self.current
+        with open(self.path, 'r') as f:
+            self.current = Settings.from_dict(json.load(f))
+        self.mtime = os.stat(self.path).st_mtime_ns
+        return self.current
+
+    def write(self, settings):
+        tmp = self.path + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(settings.to_dict(), f, indent=2)
+        os.replace(tmp, self.path)
+        self.current = settings
+        self.mtime = os.stat(self.path).st_mtime_ns
+
+    def update(self, **changes):
+        self.write(replace(self.current, **changes))
+        return self.current
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(SETTINGS_POLL_INTERVAL)
+            try:
+                if os.stat(self.path).st_mtime_ns != self.mtime:
+                    self.load()
+                    print("Reloaded settings.json")
+            except (OSError, ValueError, TypeError) as e:
+                print(f"Ignoring unreadable settings.json: {e}")
+
+settings_store = SettingsStore(SETTINGS_FILE)
+
+def load_settings():
+    return settings_store.current
 
 # ===== XP SYSTEM =====
 def get_level(xp):
     return xp // 50
 
+# ===== POST VIEWS =====
+# Captions and keyboards are cached per (view, post). Every entry remembers
+# the post and uploader versions it was built from; the repositories bump
+# those on votes, comments, XP and verification changes, so a hit is always
+# current and hot posts are not re-rendered on every impression.
+class RenderCache:
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()  # key -> (version, rendered), least recently used first
+        self.post_versions = {}
+        self.user_versions = {}
+
+    def touch_post(self, pid):
+        self.post_versions[pid] = self.post_versions.get(pid, 0) + 1
+
+    def touch_user(self, uid):
+        self.user_versions[uid] = self.user_versions.get(uid, 0) + 1
+
+    def version(self, pid, uploader):
+        return self.post_versions.get(pid, 0), self.user_versions.get(uploader, 0)
+
+    def get(self, key, version, build):
+        entry = self.entries.get(key)
+        if entry and entry[0] == version:
+            self.entries.move_to_end(key)
+            metrics.count("render.hit")
+            return entry[1]
+        metrics.count("render.miss")
+        rendered = build()
+        self.entries[key] = (version, rendered)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return rendered
+
+render_cache = RenderCache(RENDER_CACHE_SIZE)
+
+def post_badge(uid):
+    def build():
+        user_data = repo.user(uid) or {}
+        verified_badge = "✅" if user_data.get("is_verified") else ""
+        return f"👤 Anonymous (Lv{get_level(user_data.get('xp', 0))}){verified_badge}"
+    return render_cache.get(("badge", uid), render_cache.version(None, uid), build)
+
+def shuffle_view(pid, post):
+    caption = f"👍🏻 {post['likes']}    👎🏻 {post['dislikes']}\n\n{post_badge(post['uploader'])}"
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton("👍🏻 Like", callback_data=f"like|{pid}"),
+         InlineKeyboardButton("👎🏻 Dislike", callback_data=f"dislike|{pid}")],
+        [InlineKeyboardButton("💬 Comment", callback_data=f"comment|{pid}"),
+         InlineKeyboardButton("📌 Save", callback_data=f"save|{pid}")],
+        [InlineKeyboardButton("👤 Follow", callback_data=f"follow|{post['uploader']}"),
+         InlineKeyboardButton("🚫 Report", callback_data=f"report|{pid}")],
+        [InlineKeyboardButton("🔁 Next", callback_data="next_shuffle")]
+    ])
+    return caption, keyboard
+
+def follower_view(pid, post):
+    uid = post['uploader']
+    caption = f"🔔 User {uid[-4:]} posted a new image!\n{post_badge(uid)}"
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton("👍🏻 Like", callback_data=f"like|{pid}"),
+         InlineKeyboardButton("👎🏻 Dislike", callback_data=f"dislike|{pid}")],
+        [InlineKeyboardButton("💬 Comment", callback_data=f"comment|{pid}"),
+         InlineKeyboardButton("📌 Save", callback_data=f"save|{pid}")],
+        [InlineKeyboardButton("🚫 Report", callback_data=f"report|{pid}"),
+         InlineKeyboardButton("🔕 Mute", callback_data=f"mute|{uid}")]
+    ])
+    return caption, keyboard
+
+def saved_view(pid, post):
+    # Sent in media groups, which can't carry buttons: see gallery_actions
+    return f"📌 Saved Post\n👍🏻 {post['likes']} | 👎🏻 {post['dislikes']}\n{post_badge(post['uploader'])}", None
+
+def trending_view(pid, post):
+    return f"🔥 Trending — 👍🏻 {post['likes']} | {post_badge(post['uploader'])}", None
+
+def today_view(pid, post):
+    time_str = time.strftime("%H:%M", time.localtime(post['timestamp']))
+    return (f"📅 Posted today at {time_str}\n👍🏻 {post['likes']} | 👎🏻 {post['dislikes']} | "
+            f"💬 {len(post.get('comments', []))}\n{post_badge(post['uploader'])}"), None
+
+POST_VIEWS = {
+    "shuffle": shuffle_view,
+    "follower": follower_view,
+    "saved": saved_view,
+    "trending": trending_view,
+    "today": today_view,
+}
+
+def render_post(view, pid, post):
+    """(caption, keyboard) for a post, served from the render cache when current."""
+    return render_cache.get((view, pid), render_cache.version(pid, post['uploader']),
+                            lambda: POST_VIEWS[view](pid, post))
+
 # ===== ADMIN CHECK =====
 def is_admin(user_id):
-    data = load_data()
-    return str(user_id) == str(ADMIN_ID) or str(user_id) in data.get('admins', [])
-
-# ===== INITIALIZE USER =====
-def initialize_user(uid, data):
-    if uid not in data['users']:
-        data['users'][uid] = {
-            "xp": 0,
-            "uploads": [],
-            "liked": [],
-            "disliked": [],
-            "saved": [],
-            "comments": {},
-            "uploaded_at": [],
-            "is_verified": False,
-            "banned": False,
-            "shuffled": [],
-            "shuffled_count": 0,
-            "referrals": 0,
-            "ref_by": None,
-            "following": [],
-            "followers": [],
-            "muted_notifications": [],
-            "anonymous_receive": True,
-            "anon_conversation": None,
-            "anon_messages": [],
-            "comment_notifications": True
-        }
+    return roles.is_admin(user_id)
+
+def is_verified(user_id):
+    return roles.is_verified(user_id)
 
 # ===== START COMMAND =====
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = str(update.effective_user.id)
     user = update.effective_user
-    data = load_data()
     settings = load_settings()
 
     # Check if user has joined the required channel
@@ -119,16 +2030,13 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    initialize_user(uid, data)
+    user_data = repo.ensure_user(uid)
 
     # ✅ Referral system (only if enabled)
-    if settings["referral_system"] and context.args:
+    if settings.referral_system and context.args:
         ref_id = context.args[0]
-        if ref_id != uid and ref_id in data['users'] and not data['users'][uid].get("ref_by"):
-            data['users'][uid]['ref_by'] = ref_id
-            data['users'][ref_id]['referrals'] += 1
-
-    save_data(data)
+        if ref_id != uid and repo.user(ref_id) and not user_data.get("ref_by"):
+            repo.referral(uid, ref_id)
 
     # Different keyboard for admin
     if is_admin(user.id):
@@ -170,17 +2078,23 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Create admin panel keyboard
     keyboard = InlineKeyboardMarkup([
         [InlineKeyboardButton(
-            f"Referral System: {'ON' if settings['referral_system'] else 'OFF'}", 
+            f"Referral System: {'ON' if settings.referral_system else 'OFF'}", 
             callback_data="toggle_referral"
         )],
         [InlineKeyboardButton("➖ -1", callback_data="upload_limit_dec"),
-         InlineKeyboardButton(f"Upload Limit: {settings['upload_limit']}", callback_data="upload_limit_info"),
+         InlineKeyboardButton(f"Upload Limit: {settings.upload_limit}", callback_data="upload_limit_info"),
          InlineKeyboardButton("➕ +1", callback_data="upload_limit_inc")],
         [InlineKeyboardButton("➖ -1", callback_data="shuffle_limit_dec"),
-         InlineKeyboardButton(f"Shuffle Limit: {settings['shuffle_limit']}", callback_data="shuffle_limit_info"),
+         InlineKeyboardButton(f"Shuffle Limit: {settings.shuffle_limit}", callback_data="shuffle_limit_info"),
          InlineKeyboardButton("➕ +1", callback_data="shuffle_limit_inc")],
         [InlineKeyboardButton(
-            f"Comment Alerts: {'ON' if settings['comment_notifications'] else 'OFF'}", 
+            f"Shuffle Mode: {'Ranked' if settings.ranked_shuffle else 'Random'}", 
+            callback_data="toggle_ranked"
+        )],
+        *rank_weight_rows(settings),
+        *weight_rows(settings, TRENDING_WEIGHTS),
+        [InlineKeyboardButton(
+            f"Comment Alerts: {'ON' if settings.comment_notifications else 'OFF'}", 
             callback_data="toggle_comments"
         )],
         [InlineKeyboardButton("👑 Manage Admins", callback_data="manage_admins")],
@@ -189,21 +2103,372 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await update.message.reply_text(
         "⚙️ **Admin Control Panel**\n\n"
-        f"🔗 Referral System: {'Enabled' if settings['referral_system'] else 'Disabled'}\n"
-        f"📤 Upload Limit: {settings['upload_limit']} per hour\n"
-        f"🔁 Shuffle Limit: {settings['shuffle_limit']} before referral\n"
-        f"💬 Comment Notifications: {'Enabled' if settings['comment_notifications'] else 'Disabled'}\n\n"
+        f"🔗 Referral System: {'Enabled' if settings.referral_system else 'Disabled'}\n"
+        f"📤 Upload Limit: {settings.upload_limit} per hour\n"
+        f"🔁 Shuffle Limit: {settings.shuffle_limit} before referral\n"
+        f"⚖️ Shuffle Mode: {'Ranked' if settings.ranked_shuffle else 'Random'}\n"
+        f"💬 Comment Notifications: {'Enabled' if settings.comment_notifications else 'Disabled'}\n\n"
         "Use the buttons below to adjust settings:",
         reply_markup=keyboard,
         parse_mode='Markdown'
     )
 
+# field -> (label, step, minimum, maximum) for the ranked shuffle weights
+RANK_WEIGHTS = {
+    "like_weight": ("👍🏻 Like Weight", 0.5, 0, 10),
+    "dislike_weight": ("👎🏻 Dislike Weight", 0.5, 0, 10),
+    "recency_half_life": ("🕒 Half-life (h)", 6, 6, 720),
+    "report_penalty": ("🚫 Report Factor", 0.1, 0, 1),
+}
+
+TRENDING_WEIGHTS = {
+    "trending_half_life": ("🔥 Trending Half-life (h)", 6, 6, 720),
+}
+
+def weight_rows(settings, weights):
+    return [[InlineKeyboardButton("➖", callback_data=f"rank_dec|{field}"),
+             InlineKeyboardButton(f"{label}: {getattr(settings, field):g}", callback_data="rank_info"),
+             InlineKeyboardButton("➕", callback_data=f"rank_inc|{field}")]
+            for field, (label, step, low, high) in weights.items()]
+
+def rank_weight_rows(settings):
+    if not settings.ranked_shuffle:
+        return []
+    return weight_rows(settings, RANK_WEIGHTS)
+
+# ===== OUTBOUND SCHEDULER =====
+# Every Bot API call goes through the bot's rate limiter (getUpdates aside).
+# Sends and edits take a token from the chat's own bucket and then one from
+# the global bucket; global tokens are handed out lane by lane, so a user's
+# reply never waits behind follower notifications or a broadcast. Callers
+# pick a lane with rate_limit_args (interactive by default). A RetryAfter
+# pauses the global bucket and the call is retried up to SEND_RETRIES times.
+LANE_INTERACTIVE, LANE_NOTIFY, LANE_BULK = 0, 1, 2
+LANES = ("interactive", "notify", "bulk")
+SEND_RETRIES = 3
+CHAT_BURST = 3
+LIMITED_ENDPOINTS = ("send", "edit", "copy", "forward")
+
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+def retry_seconds(error):
+    delay = error.retry_after
+    return delay.total_seconds() if hasattr(delay, "total_seconds") else delay
+
+class OutboundScheduler(BaseRateLimiter):
+    def __init__(self):
+        self.bucket = TokenBucket(SEND_RATE)
+        self.chats = OrderedDict()  # chat_id -> TokenBucket, least recently used first
+        self.waiting = []           # heap of (lane, seq, future)
+        self.seq = 0
+        self.wake = None
+        self.dispatcher = None
+
+    async def initialize(self):
+        self.wake = asyncio.Event()
+        self.dispatcher = asyncio.create_task(self.dispatch())
+
+    async def shutdown(self):
+        if self.dispatcher:
+            self.dispatcher.cancel()
+
+    def chat_bucket(self, chat_id):
+        bucket = self.chats.pop(chat_id, None) or TokenBucket(1 / CHAT_INTERVAL, CHAT_BURST)
+        self.chats[chat_id] = bucket
+        while len(self.chats) > 10000:
+            self.chats.popitem(last=False)
+        return bucket
+
+    async def dispatch(self):
+        while True:
+            while not self.waiting:
+                self.wake.clear()
+                await self.wake.wait()
+            await self.bucket.acquire()
+            _, _, future = heapq.heappop(self.waiting)
+            if not future.done():
+                future.set_result(None)
+
+    async def turn(self, lane):
+        future = asyncio.get_running_loop().create_future()
+        self.seq += 1
+        heapq.heappush(self.waiting, (lane, self.seq, future))
+        self.wake.set()
+        await future
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        lane = rate_limit_args or LANE_INTERACTIVE
+        limited = endpoint.startswith(LIMITED_ENDPOINTS)
+        chat_id = data.get("chat_id")
+        for attempt in range(SEND_RETRIES + 1):
+            if limited:
+                started = time.perf_counter()
+                if chat_id is not None:
+                    await self.chat_bucket(str(chat_id)).acquire()
+                await self.turn(lane)
+                metrics.record(f"outbound.{LANES[lane]}", time.perf_counter() - started)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                metrics.count("outbound.retry_after")
+                if attempt == SEND_RETRIES:
+                    raise
+                self.bucket.pause(retry_seconds(e))
+                if not limited:
+                    await asyncio.sleep(retry_seconds(e))
+
+# Chats that answered a send with Forbidden (blocked the bot) or "chat not
+# found" are skipped by notifications for DEAD_BACKOFF, doubling on every
+# further failure up to DEAD_BACKOFF_MAX. Any update from the user revives
+# them at once. The registry lives in memory only.
+class Recipients:
+    def __init__(self):
+        self.dead = {}  # chat_id -> (failures, retry_at)
+
+    def alive(self, chat_id):
+        entry = self.dead.get(str(chat_id))
+        return entry is None or time.time() >= entry[1]
+
+    def failed(self, chat_id):
+        failures = self.dead.get(str(chat_id), (0, 0))[0] + 1
+        self.dead[str(chat_id)] = (failures, time.time() + min(DEAD_BACKOFF_MAX, DEAD_BACKOFF * 2 ** (failures - 1)))
+
+    def revive(self, chat_id):
+        self.dead.pop(str(chat_id), None)
+
+recipients = Recipients()
+
+def unreachable(error):
+    return isinstance(error, Forbidden) or (isinstance(error, BadRequest) and "chat not found" in str(error).lower())
+
+async def notify(send, chat_id, *args, lane=LANE_NOTIFY, **kwargs):
+    """Best-effort send to another user: the sent message, or None if the
+    chat is known dead or the send failed."""
+    if not recipients.alive(chat_id):
+        metrics.count("notify.skipped")
+        return None
+    try:
+        message = await send(chat_id, *args, rate_limit_args=lane, **kwargs)
+    except TelegramError as e:
+        if unreachable(e):
+            recipients.failed(chat_id)
+        metrics.count("notify.failed")
+        return None
+    recipients.revive(chat_id)
+    return message
+
+# ===== FOLLOWER FAN-OUT =====
+# New-post notifications are queued and delivered by FANOUT_WORKERS tasks,
+# so the uploader is answered at once. Sends use the notification lane of
+# the outbound scheduler, which applies the rate limits. The uploader's
+# confirmation message is edited with progress.
+FANOUT_PROGRESS_INTERVAL = 5  # seconds between progress edits
+
+class FanOutJob:
+    def __init__(self, uploader, file_ids, caption, keyboard, total, status):
+        self.uploader = uploader
+        self.file_ids = file_ids  # several for an album, sent as one media group
+        self.caption = caption
+        self.keyboard = keyboard
+        self.total = total
+        self.sent = 0
+        self.failed = 0
+        self.status = status  # the uploader's confirmation message
+        self.reported = time.monotonic()
+
+    @property
+    def done(self):
+        return self.sent + self.failed >= self.total
+
+class FanOut:
+    def __init__(self):
+        self.queue = None  # created on the bot's event loop
+        self.workers = []
+
+    def start(self, bot):
+        self.queue = asyncio.Queue()
+        self.workers = [asyncio.create_task(self.worker(bot)) for _ in range(FANOUT_WORKERS)]
+
+    def stop(self):
+        for task in self.workers:
+            task.cancel()
+        if self.queue is None:
+            return
+        if self.queue.qsize():
+            print(f"Dropping {self.queue.qsize()} queued follower notifications")
+
+    def submit(self, job, recipients):
+        for chat_id in recipients:
+            self.queue.put_nowait((job, chat_id))
+
+    async def worker(self, bot):
+        while True:
+            job, chat_id = await self.queue.get()
+            try:
+                await self.deliver(bot, job, chat_id)
+            except Exception as e:
+                job.failed += 1
+                print(f"Follower notification to {chat_id} failed: {e}")
+            finally:
+                self.queue.task_done()
+            if job.done or time.monotonic() - job.reported >= FANOUT_PROGRESS_INTERVAL:
+                job.reported = time.monotonic()
+                await self.report(bot, job)
+
+    async def deliver(self, bot, job, chat_id):
+        if len(job.file_ids) > 1:
+            media = [InputMediaPhoto(file_id, caption=job.caption if i == 0 else None)
+                     for i, file_id in enumerate(job.file_ids)]
+            sent = await notify(bot.send_media_group, chat_id, media)
+        else:
+            sent = await notify(bot.send_photo, chat_id, job.file_ids[0], caption=job.caption, reply_markup=job.keyboard)
+        if sent:
+            job.sent += 1
+        else:
+            job.failed += 1
+
+    async def report(self, bot, job):
+        text = f"{uploaded_text(len(job.file_ids))}\n📣 Notified {job.sent}/{job.total} followers"
+        if not job.done:
+            text += "…"
+        try:
+            await bot.edit_message_text(text, chat_id=job.status.chat_id, message_id=job.status.message_id,
+                                        rate_limit_args=LANE_NOTIFY)
+        except TelegramError:
+            pass
+
+fanout = FanOut()
+
+# ===== COMMENT DIGESTS =====
+# Comment and reply alerts are collected per recipient for DIGEST_WINDOW
+# seconds after the first one, then delivered as a single message. A lone
+# alert still goes out as before (the post photo with the comment); a burst
+# becomes one text digest with counts and the latest snippets. Uploader
+# alerts and admin alerts are separate digests, so the admin's own posts
+# don't mix with the moderation feed.
+DIGEST_SNIPPETS = 3
+DIGEST_SNIPPET_LENGTH = 80
+
+class DigestEvent:
+    def __init__(self, kind, pid, author, text, file_id):
+        self.kind = kind  # "comment" or "reply"
+        self.pid = pid
+        self.author = author
+        self.text = text
+        self.file_id = file_id
+
+class Digests:
+    def __init__(self, window):
+        self.window = window
+        self.pending = {}  # (chat_id, audience) -> [DigestEvent]
+        self.tasks = {}
+        self.bot = None
+
+    def start(self, bot):
+        self.bot = bot
+
+    def stop(self):
+        for task in self.tasks.values():
+            task.cancel()
+        dropped = sum(len(events) for events in self.pending.values())
+        if dropped:
+            print(f"Dropping {dropped} buffered comment alerts")
+
+    def add(self, chat_id, audience, event):
+        """Queue an alert for chat_id; audience is "user" or "admin"."""
+        metrics.count("digest.events")
+        key = (chat_id, audience)
+        self.pending.setdefault(key, []).append(event)
+        if key not in self.tasks:
+            self.tasks[key] = asyncio.create_task(self.flush_later(key))
+
+    async def flush_later(self, key):
+        await asyncio.sleep(self.window)
+        del self.tasks[key]
+        events = self.pending.pop(key, [])
+        try:
+            await self.deliver(key, events)
+        except Exception as e:
+            print(f"Comment digest to {key[0]} failed: {e}")
+
+    async def deliver(self, key, events):
+        chat_id, audience = key
+        # The toggles are re-checked at delivery, so switching alerts off
+        # also silences what was already buffered.
+        if audience == "admin":
+            if not load_settings().comment_notifications:
+                return
+        else:
+            user = repo.user(str(chat_id))
+            if not user or not user.get('comment_notifications', True):
+                return
+        metrics.count("digest.sent")
+        if len(events) == 1:
+            event = events[0]
+            if audience == "admin":
+                await notify(self.bot.send_message, chat_id,
+                             f"💬 New comment on post {event.pid}:\n{event.text}\n\nFrom: User {event.author[-4:]}")
+            elif event.kind == "reply":
+                await notify(self.bot.send_photo, chat_id, event.file_id,
+                             caption=f"💬 Reply to your comment from User {event.author[-4:]}:\n\n{event.text}")
+            else:
+                await notify(self.bot.send_photo, chat_id, event.file_id,
+                             caption=f"💬 New comment from User {event.author[-4:]}:\n\n{event.text}")
+            return
+        await notify(self.bot.send_message, chat_id, digest_text(events, audience))
+
+def digest_text(events, audience):
+    comments = sum(1 for event in events if event.kind == "comment")
+    replies = len(events) - comments
+    posts = len({event.pid for event in events})
+    counts = []
+    if comments:
+        counts.append(f"{comments} new comment{'s' if comments != 1 else ''}")
+    if replies:
+        counts.append(f"{replies} repl{'ies' if replies != 1 else 'y'} to your comments")
+    lines = [f"💬 {' and '.join(counts)} across {posts} post{'s' if posts != 1 else ''}", ""]
+    for event in events[-DIGEST_SNIPPETS:]:
+        text = event.text if len(event.text) <= DIGEST_SNIPPET_LENGTH else event.text[:DIGEST_SNIPPET_LENGTH - 1] + "…"
+        source = f"User {event.author[-4:]} on {event.pid}" if audience == "admin" else f"User {event.author[-4:]}"
+        lines.append(f"• {source}: {text}")
+    if len(events) > DIGEST_SNIPPETS:
+        lines.append(f"…and {len(events) - DIGEST_SNIPPETS} more")
+    return "\n".join(lines)
+
+digests = Digests(DIGEST_WINDOW)
+
 # ===== UPLOAD PHOTO =====
 async def photo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     uid = str(user.id)
     settings = load_settings()
 
+    # Later photos of an album already being collected skip the checks
+    if albums.extend(update.message):
+        return
+
     # Check channel membership
     is_member = await check_channel_membership(context, user.id)
     if not is_member:
@@ -218,68 +2483,197 @@ async def photo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     photo = update.message.photo[-1]
     file_id = photo.file_id
-    data = load_data()
+    user_data = repo.ensure_user(uid)
 
-    initialize_user(uid, data)
-
-    if data['users'][uid].get("banned"):
+    if user_data.get("banned"):
         await update.message.reply_text("🚫 You are banned from uploading.")
         return
 
+    if albums.add(update.message, file_id):
+        return  # limit check and upload happen once the album is complete
+
     # Upload limit check (admin and verified users are unlimited)
     now = time.time()
-    uploaded_at = [t for t in data['users'][uid].get("uploaded_at", []) if now - t < 3600]
-    upload_limit = settings["upload_limit"]
+    uploaded_at = [t for t in user_data.get("uploaded_at", []) if now - t < 3600]
+    upload_limit = settings.upload_limit
     
     if (len(uploaded_at) >= upload_limit and 
         not is_admin(user.id) and 
-        not data['users'][uid].get("is_verified")):
+        not is_verified(uid)):
         await update.message.reply_text(f"⚠️ Only {upload_limit} uploads allowed per hour.")
         return
 
-    post_id = f"{uid}_{int(now)}"
-    data['posts'][post_id] = {
-        "file_id": file_id,
-        "uploader": uid,
-        "likes": 0,
-        "dislikes": 0,
-        "comments": [],
-        "timestamp": now,
-        "saved_by": [],
-        "reported_by": []
-    }
-    data['users'][uid]['uploads'].append(post_id)
-    data['users'][uid]['uploaded_at'] = uploaded_at + [now]
-    data['users'][uid]['xp'] += 5
-    
-    # Notify followers about new post
-    followers = data['users'][uid].get('followers', [])
-    for follower_id in followers:
-        if follower_id not in data['users'][uid].get('muted_notifications', []):
+    post_id, = new_post_ids(uid, now, 1)
+    repo.upload(uid, post_id, file_id, now)
+    caption, keyboard = render_post("follower", post_id, repo.post(post_id))
+    await announce_upload(update.message, uid, [file_id], caption, keyboard)
+
+def new_post_ids(uid, now, count):
+    """Ids for `count` new posts: uid_<second>, then uid_<second>_<n> for
+    more photos within the same second."""
+    base = f"{uid}_{int(now)}"
+    ids = []
+    n = 0
+    while len(ids) < count:
+        pid = f"{base}_{n}" if n else base
+        if not repo.post(pid):
+            ids.append(pid)
+        n += 1
+    return ids
+
+def uploaded_text(count):
+    return "✅ Photo uploaded successfully!" if count == 1 else f"✅ {count} photos uploaded successfully!"
+
+async def announce_upload(message, uid, file_ids, caption, keyboard):
+    # Notify followers about new post in the background
+    uploader_data = repo.user(uid)
+    muted = uploader_data.get('muted_notifications', [])
+    recipients = [f for f in uploader_data.get('followers', []) if f not in muted]
+    if not recipients:
+        await message.reply_text(uploaded_text(len(file_ids)))
+        return
+
+    status = await message.reply_text(
+        f"{uploaded_text(len(file_ids))}\n📣 Notifying {len(recipients)} followers…")
+    fanout.submit(FanOutJob(uid, file_ids, caption, keyboard, len(recipients), status), recipients)
+
+# ===== ALBUM UPLOADS =====
+# Telegram delivers an album as one message per photo sharing a
+# media_group_id. The photos are collected for ALBUM_WAIT seconds after the
+# latest one (only the first goes through the membership/ban checks), then
+# committed in one write under the upload limit, answered with one reply,
+# and sent to followers as one media group.
+ALBUM_WAIT = 1.5
+ALBUM_MAX = 10  # Telegram's media group limit
+
+class Album:
+    def __init__(self, uid, message):
+        self.uid = uid
+        self.message = message  # the first photo, replied to
+        self.file_ids = []
+        self.task = None
+
+class Albums:
+    def __init__(self):
+        self.pending = {}  # media_group_id -> Album
+
+    def extend(self, message):
+        """Collect a later photo of an album whose first photo was accepted."""
+        if message.media_group_id not in self.pending:
+            return False
+        self.add(message, message.photo[-1].file_id)
+        return True
+
+    def add(self, message, file_id):
+        if not message.media_group_id:
+            return False
+        album = self.pending.get(message.media_group_id)
+        if album is None:
+            album = self.pending[message.media_group_id] = Album(str(message.from_user.id), message)
+        album.file_ids.append(file_id)
+        if album.task:
+            album.task.cancel()
+        album.task = asyncio.create_task(self.commit_later(message.media_group_id))
+        return True
+
+    async def commit_later(self, group_id):
+        await asyncio.sleep(ALBUM_WAIT)
+        album = self.pending.pop(group_id)
+        try:
+            await commit_album(album)
+        except Exception as e:
+            print(f"Album upload for {album.uid} failed: {e}")
+
+albums = Albums()
+
+async def commit_album(album):
+    uid = album.uid
+    settings = load_settings()
+    async with transaction(uid):
+        user_data = repo.ensure_user(uid)
+        now = time.time()
+        file_ids = album.file_ids[:ALBUM_MAX]
+        if not is_admin(uid) and not is_verified(uid):
+            uploaded_at = [t for t in user_data.get("uploaded_at", []) if now - t < 3600]
+            file_ids = file_ids[:max(settings.upload_limit - len(uploaded_at), 0)]
+        if not file_ids:
+            await album.message.reply_text(f"⚠️ Only {settings.upload_limit} uploads allowed per hour.")
+            return
+        items = list(zip(new_post_ids(uid, now, len(file_ids)), file_ids))
+        repo.upload_many(uid, items, now)
+    if len(file_ids) < len(album.file_ids):
+        await album.message.reply_text(
+            f"⚠️ Only {settings.upload_limit} uploads allowed per hour; "
+            f"{len(album.file_ids) - len(file_ids)} photos were not uploaded.")
+    if len(items) == 1:
+        caption, keyboard = render_post("follower", items[0][0], repo.post(items[0][0]))
+    else:
+        caption, keyboard = f"🔔 User {uid[-4:]} posted {len(items)} new images!\n{post_badge(uid)}", None
+    await announce_upload(album.message, uid, file_ids, caption, keyboard)
+
+# ===== SHUFFLE QUEUE =====
+# Each shuffler keeps the next few posts already drawn and rendered, so /shuffle
+# and Next only pop and send. Every item carries the cursor state after its
+# draw; that state is persisted once the item is actually shown. Items whose
+# post was deleted, or that the user voted on or reported, are skipped at pop,
+# and items rendered before a version bump are re-rendered.
+ShuffleItem = namedtuple("ShuffleItem", "pid state file_id caption keyboard uploader version")
+
+def shuffle_item(pid, state):
+    post = repo.post(pid)
+    return ShuffleItem(pid, state, post['file_id'], *render_post("shuffle", pid, post),
+                       post['uploader'], render_cache.version(pid, post['uploader']))
+
+class ShuffleQueue:
+    def __init__(self):
+        self.queues = OrderedDict()  # uid -> deque of ShuffleItem, least recently used first
+        self.tails = {}              # uid -> cursor state after the last popped item
+        self.refilling = set()
+
+    def fill(self, uid):
+        queue = self.queues.setdefault(uid, deque())
+        self.queues.move_to_end(uid)
+        while len(self.queues) > SHUFFLE_QUEUE_USERS:
+            old, _ = self.queues.popitem(last=False)
+            self.tails.pop(old, None)
+            shuffle_index.forget(old)  # its exclusion sets go with the queue
+        state = queue[-1].state if queue else self.tails.get(uid) or repo.shuffle_state(uid)
+        while len(queue) < SHUFFLE_QUEUE_SIZE:
+            pid, state = draw_shuffle(uid, state)
+            if pid is None:
+                break
+            queue.append(shuffle_item(pid, state))
+        return queue
+
+    def pop(self, uid):
+        queue = self.queues.get(uid) or self.fill(uid)
+        permanent, _ = shuffle_index.exclusions(uid)
+        while queue:
+            item = queue.popleft()
+            self.tails[uid] = item.state
+            if item.pid in shuffle_index.seq_of and item.pid not in permanent:
+                if item.version != render_cache.version(item.pid, item.uploader):
+                    item = shuffle_item(item.pid, item.state)  # votes or XP changed since it was queued
+                return item
+            if not queue:
+                queue = self.fill(uid)
+        return None
+
+    def refill_later(self, uid):
+        if uid in self.refilling or len(self.queues.get(uid, ())) > SHUFFLE_QUEUE_SIZE // 2:
+            return
+        self.refilling.add(uid)
+
+        async def refill():
             try:
-                uploader_data = data['users'].get(uid, {})
-                uploader_level = get_level(uploader_data.get('xp', 0))
-                verified_badge = "✅" if uploader_data.get("is_verified") else ""
-                
-                keyboard = InlineKeyboardMarkup([
-                    [InlineKeyboardButton("👍🏻 Like", callback_data=f"like|{post_id}"),
-                     InlineKeyboardButton("👎🏻 Dislike", callback_data=f"dislike|{post_id}")],
-                    [InlineKeyboardButton("💬 Comment", callback_data=f"comment|{post_id}"),
-                     InlineKeyboardButton("📌 Save", callback_data=f"save|{post_id}")],
-                    [InlineKeyboardButton("🚫 Report", callback_data=f"report|{post_id}"),
-                     InlineKeyboardButton("🔕 Mute", callback_data=f"mute|{uid}")]
-                ])
-                await context.bot.send_photo(
-                    follower_id,
-                    file_id,
-                    caption=f"🔔 User {uid[-4:]} posted a new image!\n👤 Anonymous (Lv{uploader_level}){verified_badge}",
-                    reply_markup=keyboard
-                )
-            except:
-                pass  # User might have blocked the bot
-    
-    save_data(data)
-    await update.message.reply_text("✅ Photo uploaded successfully!")
+                self.fill(uid)
+            except Exception as e:
+                print(f"Shuffle prefetch failed for {uid}: {e}")
+            finally:
+                self.refilling.discard(uid)
+        asyncio.create_task(refill())
+
+shuffle_queue = ShuffleQueue()
 
 # ===== SHUFFLE =====
 async def shuffle(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -298,105 +2692,81 @@ async def shuffle(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    data = load_data()
-    initialize_user(uid, data)
-    user_data = data['users'][uid]
+    user_data = repo.ensure_user(uid)
 
     # Shuffle limit check (only if referral system is enabled and user is not admin/verified)
-    if (settings["referral_system"] and 
-        len(user_data.get('shuffled', [])) >= settings["shuffle_limit"] and 
+    if (settings.referral_system and 
+        user_data.get('shuffled_count', 0) >= settings.shuffle_limit and 
         user_data.get("referrals", 0) < 3 and 
         not is_admin(update.effective_user.id) and 
-        not user_data.get("is_verified")):
+        not is_verified(uid)):
         await update.message.reply_text(
-            f"🔒 You have reached the free shuffle limit ({settings['shuffle_limit']}).\n"
+            f"🔒 You have reached the free shuffle limit ({settings.shuffle_limit}).\n"
             "Refer 3 friends to unlock unlimited shuffle access!\n\n"
             "👉 Share this link:\n"
             f"https://t.me/{context.bot.username}?start={uid}"
         )
         return
 
-    seen = user_data.get("shuffled", [])
-    liked = user_data.get("liked", [])
-    disliked = user_data.get("disliked", [])
-    own_posts = user_data.get("uploads", [])
-    all_posts = list(data['posts'].keys())
-
-    # Filter out already seen posts, liked/disliked posts, and own posts
-    available = [pid for pid in all_posts if pid not in seen and pid not in liked and pid not in disliked and pid not in own_posts]
+    item = shuffle_queue.pop(uid)
 
-    if not available:
+    if item is None:
         await update.message.reply_text("📭 No new posts available to shuffle. You've seen all available posts!")
         return
 
-    pid = random.choice(available)
-    post = data['posts'][pid]
-    file_id = post['file_id']
-    uploader_uid = post['uploader']
-    uploader_data = data['users'].get(uploader_uid, {})
-    uploader_level = get_level(uploader_data.get('xp', 0))
-    verified_badge = "✅" if uploader_data.get("is_verified") else ""
-    caption = f"👍🏻 {post['likes']}    👎🏻 {post['dislikes']}\n\n👤 Anonymous (Lv{uploader_level}){verified_badge}"
-
-    keyboard = InlineKeyboardMarkup([
-        [InlineKeyboardButton("👍🏻 Like", callback_data=f"like|{pid}"),
-         InlineKeyboardButton("👎🏻 Dislike", callback_data=f"dislike|{pid}")],
-        [InlineKeyboardButton("💬 Comment", callback_data=f"comment|{pid}"),
-         InlineKeyboardButton("📌 Save", callback_data=f"save|{pid}")],
-        [InlineKeyboardButton("👤 Follow", callback_data=f"follow|{uploader_uid}"),
-         InlineKeyboardButton("🚫 Report", callback_data=f"report|{pid}")],
-        [InlineKeyboardButton("🔁 Next", callback_data="next_shuffle")]
-    ])
-
-    await update.message.reply_photo(file_id, caption=caption, reply_markup=keyboard)
-    user_data['shuffled'].append(pid)
-    user_data['shuffled'] = user_data['shuffled'][-1000:]  # Keep last 1000 shuffled posts
-    save_data(data)
+    await update.message.reply_photo(item.file_id, caption=item.caption, reply_markup=item.keyboard)
+    repo.shuffled(uid, item.pid, item.state)
+    shuffle_queue.refill_later(uid)
 
 # ===== BUTTON ACTIONS =====
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     user = query.from_user
     uid = str(user.id)
-    data = load_data()
     settings = load_settings()
     await query.answer()
 
     # Initialize user if not exists
-    initialize_user(uid, data)
+    user_data = repo.ensure_user(uid)
 
     # Admin panel actions
     if is_admin(user.id):
         if query.data == "toggle_referral":
-            settings["referral_system"] = not settings["referral_system"]
-            save_settings(settings)
+            settings = settings_store.update(referral_system=not settings.referral_system)
             await admin_panel_update(query, settings)
             return
         elif query.data == "upload_limit_inc":
-            settings["upload_limit"] += 1
-            save_settings(settings)
+            settings = settings_store.update(upload_limit=settings.upload_limit + 1)
             await admin_panel_update(query, settings)
             return
         elif query.data == "upload_limit_dec":
-            if settings["upload_limit"] > 1:
-                settings["upload_limit"] -= 1
-                save_settings(settings)
+            if settings.upload_limit > 1:
+                settings = settings_store.update(upload_limit=settings.upload_limit - 1)
             await admin_panel_update(query, settings)
             return
         elif query.data == "shuffle_limit_inc":
-            settings["shuffle_limit"] += 1
-            save_settings(settings)
+            settings = settings_store.update(shuffle_limit=settings.shuffle_limit + 1)
             await admin_panel_update(query, settings)
             return
         elif query.data == "shuffle_limit_dec":
-            if settings["shuffle_limit"] > 1:
-                settings["shuffle_limit"] -= 1
-                save_settings(settings)
+            if settings.shuffle_limit > 1:
+                settings = settings_store.update(shuffle_limit=settings.shuffle_limit - 1)
             await admin_panel_update(query, settings)
             return
         elif query.data == "toggle_comments":
-            settings["comment_notifications"] = not settings["comment_notifications"]
-            save_settings(settings)
+            settings = settings_store.update(comment_notifications=not settings.comment_notifications)
+            await admin_panel_update(query, settings)
+            return
+        elif query.data == "toggle_ranked":
+            settings = settings_store.update(ranked_shuffle=not settings.ranked_shuffle)
+            await admin_panel_update(query, settings)
+            return
+        elif query.data.split("|")[0] in ("rank_inc", "rank_dec"):
+            action, field = query.data.split("|")
+            label, step, low, high = {**RANK_WEIGHTS, **TRENDING_WEIGHTS}[field]
+            value = getattr(settings, field) + (step if action == "rank_inc" else -step)
+            value = round(min(high, max(low, value)), 2)
+            settings = settings_store.update(**{field: type(getattr(settings, field))(value)})
             await admin_panel_update(query, settings)
             return
         elif query.data == "refresh_admin":
@@ -413,16 +2783,25 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif query.data == "leaderboard_daily":
         await show_daily_leaderboard(query, context)
         return
+    elif query.data == "leaderboard_weekly":
+        await show_weekly_leaderboard(query, context)
+        return
+    elif query.data == "leaderboard_monthly":
+        await show_monthly_leaderboard(query, context)
+        return
+    elif query.data.startswith("trending_page|"):
+        # The button's message may be too old to reply to, so send to the user
+        await send_trending(context.bot, query.from_user.id, int(query.data.split("|")[1]))
+        return
+    elif query.data.startswith("gallery|"):
+        await gallery_more(query, context)
+        return
 
     # Handle make admin callback
     if "|" in query.data and query.data.split("|")[0] == "make_admin":
         if str(query.from_user.id) == str(ADMIN_ID):  # Only main admin can make others admin
             _, target_uid = query.data.split("|")
-            if target_uid not in data.get('admins', []):
-                if 'admins' not in data:
-                    data['admins'] = []
-                data['admins'].append(target_uid)
-                save_data(data)
+            if repo.add_admin(target_uid):
                 await query.answer(f"✅ User {target_uid} is now an admin!")
                 try:
                     await context.bot.send_message(target_uid, "🎉 You have been promoted to admin!")
@@ -438,10 +2817,10 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if "|" in query.data and query.data.split("|")[0] in ["top_posts", "today_posts", "toggle_anon", "toggle_comment_notif"]:
         if query.data.split("|")[0] == "toggle_anon":
             # Toggle anonymous chat setting
-            data['users'][uid]['anonymous_receive'] = not data['users'][uid].get('anonymous_receive', True)
-            save_data(data)
+            anonymous_receive = not user_data.get('anonymous_receive', True)
+            repo.set_user(uid, 'anonymous_receive', anonymous_receive)
             
-            status = "🔓 ON" if data['users'][uid]['anonymous_receive'] else "🔒 OFF"
+            status = "🔓 ON" if anonymous_receive else "🔒 OFF"
             await query.answer(f"Anonymous chat toggled {status}")
             
             # Update the profile message
@@ -449,10 +2828,10 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         elif query.data.split("|")[0] == "toggle_comment_notif":
             # Toggle comment notifications
-            data['users'][uid]['comment_notifications'] = not data['users'][uid].get('comment_notifications', True)
-            save_data(data)
+            comment_notifications = not user_data.get('comment_notifications', True)
+            repo.set_user(uid, 'comment_notifications', comment_notifications)
             
-            status = "🔔 ON" if data['users'][uid]['comment_notifications'] else "🔕 OFF"
+            status = "🔔 ON" if comment_notifications else "🔕 OFF"
             await query.answer(f"Comment notifications {status}")
             
             # Update the profile message
@@ -475,17 +2854,17 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         _, sender_uid = query.data.split("|")
         
         # Check if sender exists and initialize if needed
-        initialize_user(sender_uid, data)
+        repo.ensure_user(sender_uid)
         
         # Check if user has anonymous chat enabled
-        if not data['users'][uid].get('anonymous_receive', True):
+        if not user_data.get('anonymous_receive', True):
             await query.answer("🔒 You have anonymous chat disabled.")
             return
         
         # Set up conversation mode
-        data['users'][uid]['anon_conversation'] = sender_uid
-        data['users'][sender_uid]['anon_conversation'] = uid
-        save_data(data)
+        async with transaction(uid, users=(sender_uid,)):
+            repo.set_user(uid, 'anon_conversation', sender_uid)
+            repo.set_user(sender_uid, 'anon_conversation', uid)
         
         context.user_data['anon_chat_mode'] = True
         await query.answer("💭 Reply mode activated...")
@@ -502,37 +2881,33 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if "|" in query.data:
         action, pid = query.data.split("|")
-        post = data['posts'].get(pid)
+        post = repo.post(pid)
 
         if not post:
-            await query.edit_message_caption("❌ This post was deleted.")
+            if query.message is not None and query.message.is_accessible and query.message.caption is None:
+                await context.bot.send_message(uid, "❌ This post was deleted.")  # a gallery footer
+            else:
+                await query.edit_message_caption("❌ This post was deleted.")
             return
 
-        if action == "like" and pid not in data['users'][uid]['liked']:
-            post['likes'] += 1
-            data['users'][uid]['liked'].append(pid)
-            data['users'][uid]['xp'] += 1
-            # Give uploader +2 XP
-            uploader_id = post['uploader']
-            if uploader_id in data['users']:
-                data['users'][uploader_id]['xp'] += 2
+        if action == "like":
+            async with transaction(uid, pid):
+                if pid not in user_data['liked']:
+                    repo.like(uid, pid)
 
-        elif action == "dislike" and pid not in data['users'][uid]['disliked']:
-            post['dislikes'] += 1
-            data['users'][uid]['disliked'].append(pid)
-            # Give uploader +2 XP
-            uploader_id = post['uploader']
-            if uploader_id in data['users']:
-                data['users'][uploader_id]['xp'] += 2
+        elif action == "dislike":
+            async with transaction(uid, pid):
+                if pid not in user_data['disliked']:
+                    repo.dislike(uid, pid)
 
         elif action == "save":
-            if pid not in data['users'][uid]['saved']:
-                data['users'][uid]['saved'].append(pid)
+            async with transaction(uid, pid):
+                saved = pid not in user_data['saved'] and repo.save(uid, pid)
+            if saved:
                 await context.bot.send_message(uid, "✅ Saved!")
 
         elif action == "comment":
             # Show existing comments for this post with reply buttons
-            post = data['posts'].get(pid)
             if not post:
                 await query.answer("❌ Post not found.")
                 return
@@ -563,48 +2938,38 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 context.user_data['commenting'] = pid
 
         elif action == "report":
-            if uid not in post['reported_by']:
-                post['reported_by'].append(uid)
+            async with transaction(uid, pid):
+                if uid in post['reported_by'] or not repo.post(pid):
+                    return
+                report_count = repo.report(uid, pid)
                 # If admin reports, delete immediately
-                if is_admin(user.id):
-                    # Remove post from uploader's uploads list
-                    uploader_id = post['uploader']
-                    if uploader_id in data['users'] and pid in data['users'][uploader_id]['uploads']:
-                        data['users'][uploader_id]['uploads'].remove(pid)
-                    del data['posts'][pid]
-                    await query.edit_message_caption("⚠️ This post was removed by admin.")
-                elif len(post['reported_by']) >= 10:
-                    # Remove post from uploader's uploads list
-                    uploader_id = post['uploader']
-                    if uploader_id in data['users'] and pid in data['users'][uploader_id]['uploads']:
-                        data['users'][uploader_id]['uploads'].remove(pid)
-                    del data['posts'][pid]
-                    await query.edit_message_caption("⚠️ This post was removed (too many reports).")
-                else:
-                    await context.bot.send_message(uid, "🚨 Reported.")
+                removed = is_admin(user.id) or report_count >= 10
+                if removed:
+                    repo.delete_post(pid)
+            if is_admin(user.id):
+                await query.edit_message_caption("⚠️ This post was removed by admin.")
+            elif removed:
+                await query.edit_message_caption("⚠️ This post was removed (too many reports).")
+            else:
+                await context.bot.send_message(uid, "🚨 Reported.")
                     
         elif action == "follow":
             target_uid = pid  # The pid is the target user's ID in this case
-            initialize_user(target_uid, data)
+            async with transaction(uid, users=(target_uid,)):
+                repo.ensure_user(target_uid)
+                followed = repo.follow(uid, target_uid)
             
-            if target_uid not in data['users'][uid]['following']:
-                data['users'][uid]['following'].append(target_uid)
-                data['users'][target_uid]['followers'].append(uid)
+            if followed:
                 await query.answer("✅ You are now following this user!")
                 # Notify the followed user
-                try:
-                    await context.bot.send_message(target_uid, f"🔔 User {uid[-4:]} started following you!")
-                except:
-                    pass  # User might have blocked the bot
+                await notify(context.bot.send_message, target_uid, f"🔔 User {uid[-4:]} started following you!")
             else:
                 await query.answer("✅ You are already following this user!")
-            save_data(data)
             return  # Don't update caption for follow action
         
         elif action == "mute":
             target_uid = pid  # The pid is the target user's ID in this case
-            if target_uid not in data['users'][uid].get('muted_notifications', []):
-                data['users'][uid]['muted_notifications'].append(target_uid)
+            if repo.mute(uid, target_uid):
                 await context.bot.send_message(uid, f"🔕 Muted notifications from User {target_uid[-4:]}!")
             else:
                 await context.bot.send_message(uid, f"You have already muted User {target_uid[-4:]}!")
@@ -641,27 +3006,14 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await handle_anon_chat(query, context)
         return
 
-    # Update caption
-    if "|" in query.data and "report" not in query.data and "follow" not in query.data and "mute" not in query.data:
-        post = data['posts'].get(pid)
-        if post:
-            uploader_uid = post['uploader']
-            uploader_data = data['users'].get(uploader_uid, {})
-            uploader_level = get_level(uploader_data.get('xp', 0))
-            verified_badge = "✅" if uploader_data.get("is_verified") else ""
-            new_caption = f"👍🏻 {post['likes']}    👎🏻 {post['dislikes']}\n\n👤 Anonymous (Lv{uploader_level}){verified_badge}"
-            try:
-                await query.edit_message_caption(new_caption, reply_markup=query.message.reply_markup)
-            except Exception as e:
-                # Handle cases where message content hasn't changed
-                pass
-
-    save_data(data)
+    # Update caption; only votes change what it shows
+    if "|" in query.data and query.data.split("|")[0] in ("like", "dislike"):
+        if query.message is not None and query.message.is_accessible and query.message.caption is not None:
+            caption_edits.refresh(context.bot, query.message, pid)
 
 # ===== MANAGE ADMINS MENU =====
 async def manage_admins_menu(query, context: ContextTypes.DEFAULT_TYPE):
-    data = load_data()
-    admins = data.get('admins', [])
+    admins = repo.admins()
     
     msg = "👑 **Admin Management**\n\n"
     msg += f"🔑 Main Admin: {ADMIN_ID}\n"
@@ -682,17 +3034,23 @@ async def admin_panel_update(query, settings):
     # Create admin panel keyboard
     keyboard = InlineKeyboardMarkup([
         [InlineKeyboardButton(
-            f"Referral System: {'ON' if settings['referral_system'] else 'OFF'}", 
+            f"Referral System: {'ON' if settings.referral_system else 'OFF'}", 
             callback_data="toggle_referral"
         )],
         [InlineKeyboardButton("➖ -1", callback_data="upload_limit_dec"),
-         InlineKeyboardButton(f"Upload Limit: {settings['upload_limit']}", callback_data="upload_limit_info"),
+         InlineKeyboardButton(f"Upload Limit: {settings.upload_limit}", callback_data="upload_limit_info"),
          InlineKeyboardButton("➕ +1", callback_data="upload_limit_inc")],
         [InlineKeyboardButton("➖ -1", callback_data="shuffle_limit_dec"),
-         InlineKeyboardButton(f"Shuffle Limit: {settings['shuffle_limit']}", callback_data="shuffle_limit_info"),
+         InlineKeyboardButton(f"Shuffle Limit: {settings.shuffle_limit}", callback_data="shuffle_limit_info"),
          InlineKeyboardButton("➕ +1", callback_data="shuffle_limit_inc")],
         [InlineKeyboardButton(
-            f"Comment Alerts: {'ON' if settings['comment_notifications'] else 'OFF'}", 
+            f"Shuffle Mode: {'Ranked' if settings.ranked_shuffle else 'Random'}", 
+            callback_data="toggle_ranked"
+        )],
+        *rank_weight_rows(settings),
+        *weight_rows(settings, TRENDING_WEIGHTS),
+        [InlineKeyboardButton(
+            f"Comment Alerts: {'ON' if settings.comment_notifications else 'OFF'}", 
             callback_data="toggle_comments"
         )],
         [InlineKeyboardButton("👑 Manage Admins", callback_data="manage_admins")],
@@ -702,10 +3060,11 @@ async def admin_panel_update(query, settings):
     try:
         await query.edit_message_text(
             "⚙️ **Admin Control Panel**\n\n"
-            f"🔗 Referral System: {'Enabled' if settings['referral_system'] else 'Disabled'}\n"
-            f"📤 Upload Limit: {settings['upload_limit']} per hour\n"
-            f"🔁 Shuffle Limit: {settings['shuffle_limit']} before referral\n"
-            f"💬 Comment Notifications: {'Enabled' if settings['comment_notifications'] else 'Disabled'}\n\n"
+            f"🔗 Referral System: {'Enabled' if settings.referral_system else 'Disabled'}\n"
+            f"📤 Upload Limit: {settings.upload_limit} per hour\n"
+            f"🔁 Shuffle Limit: {settings.shuffle_limit} before referral\n"
+            f"⚖️ Shuffle Mode: {'Ranked' if settings.ranked_shuffle else 'Random'}\n"
+            f"💬 Comment Notifications: {'Enabled' if settings.comment_notifications else 'Disabled'}\n\n"
             "Use the buttons below to adjust settings:",
             reply_markup=keyboard,
             parse_mode='Markdown'
@@ -713,85 +3072,180 @@ async def admin_panel_update(query, settings):
     except:
         pass
 
+# ===== CALLBACK DEBOUNCE =====
+# Button mashing on a post produces bursts of identical callbacks and
+# caption edits. A callback identical to one of the same user's still in
+# flight (same message, same data) is answered and dropped before it queues
+# behind per_user. Caption refreshes are coalesced per message: the first
+# one waits EDIT_DEBOUNCE seconds, later ones join it, and the single edit
+# renders the post as it is by then. Edits that would not change the
+# caption are skipped instead of failing with "message is not modified".
+EDITED_CAPTIONS_SIZE = 10000  # last caption per message, to skip no-op edits
+
+def dedupe_callbacks(handler):
+    inflight = set()
+
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        query = update.callback_query
+        message = query.message
+        # chat.id, not chat_id: old messages arrive as InaccessibleMessage
+        where = (message.chat.id, message.message_id) if message else query.inline_message_id
+        key = (query.from_user.id, where, query.data)
+        if key in inflight:
+            metrics.count("callbacks.duplicate")
+            try:
+                await query.answer()
+            except TelegramError:
+                pass
+            return
+        inflight.add(key)
+        try:
+            return await handler(update, context)
+        finally:
+            inflight.discard(key)
+    return wrapper
+
+class CaptionEdits:
+    def __init__(self, window):
+        self.window = window
+        self.pending = {}  # (chat_id, message_id) -> (pid, reply_markup)
+        self.captions = OrderedDict()
+        self.tasks = set()
+
+    def refresh(self, bot, message, pid):
+        """Re-render post `pid` into `message` soon, once per burst."""
+        metrics.count("edits.requested")
+        key = (message.chat_id, message.message_id)
+        if key not in self.captions and message.caption:
+            self.remember(key, message.caption)  # what the message shows now
+        if key not in self.pending:
+            task = asyncio.create_task(self.flush_later(bot, key))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        self.pending[key] = (pid, message.reply_markup)
+
+    def forget(self, message):
+        """The message now shows something else (Next): drop its pending edit."""
+        key = (message.chat_id, message.message_id)
+        self.pending.pop(key, None)
+        self.captions.pop(key, None)
+
+    async def flush_later(self, bot, key):
+        await asyncio.sleep(self.window)
+        if key not in self.pending:
+            return
+        pid, reply_markup = self.pending.pop(key)
+        post = repo.post(pid)
+        if not post:
+            return
+        caption, _ = render_post("shuffle", pid, post)
+        if self.captions.get(key) == caption.strip():
+            metrics.count("edits.skipped")
+            return
+        try:
+            await bot.edit_message_caption(chat_id=key[0], message_id=key[1], caption=caption,
+                                           reply_markup=reply_markup)
+        except TelegramError as e:
+            if classify_edit_error(e) != "unchanged":
+                return
+        metrics.count("edits.sent")
+        self.remember(key, caption)
+
+    def remember(self, key, caption):
+        # Telegram trims captions, so compare them trimmed
+        self.captions[key] = caption.strip()
+        self.captions.move_to_end(key)
+        if len(self.captions) > EDITED_CAPTIONS_SIZE:
+            self.captions.popitem(last=False)
+
+caption_edits = CaptionEdits(EDIT_DEBOUNCE)
+
+# ===== NEXT RENDERING =====
+# Next swaps photo, caption and keyboard in a single edit_message_media call.
+# When the edit fails the error decides the fallback: "not modified" needs
+# nothing, a message that can no longer be edited (too old, gone) gets a
+# fresh send_photo without a doomed delete, anything else is replaced.
+UNCHANGED_ERRORS = ("message is not modified",)
+STALE_ERRORS = ("message can't be edited", "message to edit not found", "message_id_invalid", "message can't be deleted")
+
+def classify_edit_error(error):
+    if not isinstance(error, BadRequest):
+        return "replace"
+    text = str(error).lower()
+    if any(e in text for e in UNCHANGED_ERRORS):
+        return "unchanged"
+    if any(e in text for e in STALE_ERRORS):
+        return "stale"
+    return "replace"
+
+async def show_shuffle_item(query, context, item):
+    message = query.message
+    metrics.count("next.presses")
+    calls = 0
+    outcome = "stale"
+    try:
+        if message is not None and message.is_accessible:
+            caption_edits.forget(message)
+            calls += 1
+            try:
+                await query.edit_message_media(
+                    media=InputMediaPhoto(item.file_id, caption=item.caption),
+                    reply_markup=item.keyboard
+                )
+                outcome = "edited"
+                return
+            except TelegramError as e:
+                outcome = classify_edit_error(e)
+            if outcome == "unchanged":
+                return
+            if outcome == "replace":
+                calls += 1
+                try:
+                    await message.delete()
+                except TelegramError:
+                    pass
+        calls += 1
+        await context.bot.send_photo(
+            chat_id=query.from_user.id if message is None else message.chat.id,
+            photo=item.file_id,
+            caption=item.caption,
+            reply_markup=item.keyboard
+        )
+    finally:
+        metrics.count(f"next.{outcome}")
+        metrics.count("next.api_calls", calls)
+
 # ===== SHUFFLE CALLBACK FOR NEXT BUTTON =====
 async def shuffle_callback(query, context: ContextTypes.DEFAULT_TYPE):
     uid = str(query.from_user.id)
-    data = load_data()
     settings = load_settings()
 
-    initialize_user(uid, data)
-    user_data = data['users'][uid]
+    user_data = repo.ensure_user(uid)
 
     # Shuffle limit check (only if referral system is enabled and user is not admin/verified)
-    if (settings["referral_system"] and 
-        len(user_data.get('shuffled', [])) >= settings["shuffle_limit"] and 
+    if (settings.referral_system and 
+        user_data.get('shuffled_count', 0) >= settings.shuffle_limit and 
         user_data.get("referrals", 0) < 3 and 
         not is_admin(query.from_user.id) and 
-        not user_data.get("is_verified")):
+        not is_verified(uid)):
         await query.edit_message_caption(
-            f"🔒 You have reached the free shuffle limit ({settings['shuffle_limit']}).\n"
+            f"🔒 You have reached the free shuffle limit ({settings.shuffle_limit}).\n"
             "Refer 3 friends to unlock unlimited shuffle access!\n\n"
             "👉 Share this link:\n"
             f"https://t.me/{context.bot.username}?start={uid}"
         )
         return
 
-    seen = user_data.get("shuffled", [])
-    liked = user_data.get("liked", [])
-    disliked = user_data.get("disliked", [])
-    own_posts = user_data.get("uploads", [])
-    all_posts = list(data['posts'].keys())
-
-    # Filter out already seen posts, liked/disliked posts, and own posts
-    available = [pid for pid in all_posts if pid not in seen and pid not in liked and pid not in disliked and pid not in own_posts]
+    item = shuffle_queue.pop(uid)
 
-    if not available:
+    if item is None:
         await query.edit_message_caption("📭 No new posts available to shuffle. You've seen all available posts!")
         return
 
-    pid = random.choice(available)
-    post = data['posts'][pid]
-    file_id = post['file_id']
-    uploader_uid = post['uploader']
-    uploader_data = data['users'].get(uploader_uid, {})
-    uploader_level = get_level(uploader_data.get('xp', 0))
-    verified_badge = "✅" if uploader_data.get("is_verified") else ""
-    caption = f"👍🏻 {post['likes']}    👎🏻 {post['dislikes']}\n\n👤 Anonymous (Lv{uploader_level}){verified_badge}"
-
-    keyboard = InlineKeyboardMarkup([
-        [InlineKeyboardButton("👍🏻 Like", callback_data=f"like|{pid}"),
-         InlineKeyboardButton("👎🏻 Dislike", callback_data=f"dislike|{pid}")],
-        [InlineKeyboardButton("💬 Comment", callback_data=f"comment|{pid}"),
-         InlineKeyboardButton("📌 Save", callback_data=f"save|{pid}")],
-        [InlineKeyboardButton("👤 Follow", callback_data=f"follow|{uploader_uid}"),
-         InlineKeyboardButton("🚫 Report", callback_data=f"report|{pid}")],
-        [InlineKeyboardButton("🔁 Next", callback_data="next_shuffle")]
-    ])
-
-    try:
-        # Try to edit the media and caption
-        await query.edit_message_media(
-            media=query.message.photo[0].file_id,
-            reply_markup=keyboard
-        )
-        await query.edit_message_caption(caption=caption, reply_markup=keyboard)
-    except:
-        # If editing fails, delete the old message and send a new one
-        try:
-            await query.message.delete()
-        except:
-            pass
-        
-        await context.bot.send_photo(
-            chat_id=query.message.chat_id,
-            photo=file_id,
-            caption=caption,
-            reply_markup=keyboard
-        )
-
-    user_data['shuffled'].append(pid)
-    user_data['shuffled'] = user_data['shuffled'][-1000:]  # Keep last 1000 shuffled posts
-    save_data(data)
+    await show_shuffle_item(query, context, item)
+    repo.shuffled(uid, item.pid, item.state)
+    shuffle_queue.refill_later(uid)
 
 # ===== KEYBOARD BUTTON HANDLER =====
 async def keyboard_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -825,21 +3279,10 @@ async def keyboard_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ===== COMMENTS TODAY HANDLER =====
 async def comments_today(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = str(update.effective_user.id)
-    data = load_data()
-    
-    initialize_user(uid, data)
-    
     now = time.time()
     today_start = now - (now % 86400)
     
-    posts_with_comments = {}
-    for post_id in data['users'][uid].get('uploads', []):
-        if post_id in data['posts']:
-            post = data['posts'][post_id]
-            today_comments = [c for c in post.get('comments', []) 
-                            if c.get('timestamp', 0) >= today_start]
-            if today_comments:
-                posts_with_comments[post_id] = today_comments
+    posts_with_comments = repo.comments_since(uid, today_start)
     
     if not posts_with_comments:
         await update.message.reply_text("💬 No comments received today.")
@@ -847,17 +3290,12 @@ async def comments_today(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
     await update.message.reply_text(f"💬 Posts with comments today ({len(posts_with_comments)} posts):")
     
-    for post_id, comments in posts_with_comments.items():
-        post = data['posts'][post_id]
-        uploader_data = data['users'].get(uid, {})
-        uploader_level = get_level(uploader_data.get('xp', 0))
-        verified_badge = "✅" if uploader_data.get("is_verified") else ""
-        
+    for post_id, post, comments in posts_with_comments:
         # Send the post first
         await context.bot.send_photo(
             uid,
             post['file_id'],
-            caption=f"💬 Comments today: {len(comments)}\n👤 Anonymous (Lv{uploader_level}){verified_badge}"
+            caption=f"💬 Comments today: {len(comments)}\n{post_badge(uid)}"
         )
         
         # Send each comment with reply button
@@ -878,55 +3316,34 @@ async def comments_today(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ===== COMMENT MESSAGE =====
 async def comment_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = str(update.effective_user.id)
-    data = load_data()
     settings = load_settings()
 
-    initialize_user(uid, data)
+    repo.ensure_user(uid)
 
     if 'commenting' in context.user_data:
         pid = context.user_data['commenting']
         text = update.message.text
-        if pid in data['posts']:
-            comment_data = {
-                "user": uid, 
-                "text": text, 
-                "timestamp": time.time(),
-                "replies": []
-            }
-            data['posts'][pid]['comments'].append(comment_data)
-            data['users'][uid]['xp'] += 1
-
+        async with transaction(uid, pid):
+            post = repo.post(pid)
+            comment_count = repo.comment(uid, pid, text, time.time()) if post else 0
+        if post:
             # Notify post uploader
-            uploader_id = data['posts'][pid]['uploader']
-            if uploader_id != uid and uploader_id in data['users']:  # Don't notify self
+            uploader_id = post['uploader']
+            uploader_data = repo.user(uploader_id)
+            if uploader_id != uid and uploader_data:  # Don't notify self
                 # Check if uploader wants comment notifications
-                if data['users'][uploader_id].get('comment_notifications', True):
-                    try:
-                        await context.bot.send_photo(
-                            uploader_id,
-                            data['posts'][pid]['file_id'],
-                            caption=f"💬 New comment from User {uid[-4:]}:\n\n{text}"
-                        )
-                    except:
-                        pass
+                if uploader_data.get('comment_notifications', True):
+                    digests.add(uploader_id, "user", DigestEvent("comment", pid, uid, text, post['file_id']))
 
             # Notify admin if comment notifications are enabled
-            if settings["comment_notifications"]:
-                try:
-                    await context.bot.send_message(
-                        ADMIN_ID, 
-                        f"💬 New comment on post {pid}:\n{text}\n\nFrom: User {uid[-4:]}"
-                    )
-                except:
-                    pass
+            if settings.comment_notifications:
+                digests.add(ADMIN_ID, "admin", DigestEvent("comment", pid, uid, text, post['file_id']))
 
             # Show updated comments count
-            comment_count = len(data['posts'][pid]['comments'])
             await update.message.reply_text(f"✅ Comment added! ({comment_count} comments total)")
         else:
             await update.message.reply_text("❌ Post not found.")
         del context.user_data['commenting']
-        save_data(data)
     elif 'replying_to' in context.user_data:
         # Handle comment replies
         reply_info = context.user_data['replying_to']
@@ -934,55 +3351,43 @@ async def comment_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         comment_idx = reply_info['comment_idx']
         text = update.message.text
         
-        if post_id in data['posts'] and comment_idx < len(data['posts'][post_id]['comments']):
-            # Add reply to the comment
-            reply_data = {
-                "user": uid,
-                "text": text,
-                "timestamp": time.time()
-            }
-            data['posts'][post_id]['comments'][comment_idx]['replies'].append(reply_data)
-            
+        async with transaction(uid, post_id):
+            post = repo.post(post_id)
+            replied = post and comment_idx < len(post['comments'])
+            if replied:
+                # Add reply to the comment
+                repo.reply(uid, post_id, comment_idx, text, time.time())
+        if replied:
             # Notify the original commenter
-            original_commenter = data['posts'][post_id]['comments'][comment_idx]['user']
-            if original_commenter != uid and original_commenter in data['users']:
+            original_commenter = post['comments'][comment_idx]['user']
+            commenter_data = repo.user(original_commenter)
+            if original_commenter != uid and commenter_data:
                 # Check if commenter wants notifications
-                if data['users'][original_commenter].get('comment_notifications', True):
-                    try:
-                        await context.bot.send_photo(
-                            original_commenter,
-                            data['posts'][post_id]['file_id'],
-                            caption=f"💬 Reply to your comment from User {uid[-4:]}:\n\n{text}"
-                        )
-                    except:
-                        pass
+                if commenter_data.get('comment_notifications', True):
+                    digests.add(original_commenter, "user",
+                                DigestEvent("reply", post_id, uid, text, post['file_id']))
             
             await update.message.reply_text("✅ Reply sent!")
         else:
             await update.message.reply_text("❌ Comment not found.")
         del context.user_data['replying_to']
-        save_data(data)
     elif 'anon_chat_mode' in context.user_data:
         # Handle anonymous chat messages
         await handle_anonymous_message(update, context)
-        save_data(data)
     elif 'anon_reply_target' in context.user_data:
         # Handle anonymous replies
         await handle_anonymous_reply(update, context)
-        save_data(data)
 
 # ===== /PROFILE COMMAND =====
 async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     uid = str(user.id)
-    data = load_data()
-    
-    initialize_user(uid, data)
-    udata = data['users'][uid]
+    udata = repo.ensure_user(uid)
 
     uploads = len(udata['uploads'])
     xp = udata['xp']
     lvl = get_level(xp)
+    rank = xp_board.rank(uid)
     refs = udata.get('referrals', 0)
     saved = len(udata.get("saved", []))
     verified = "✅" if udata.get("is_verified") else "❌"
@@ -1009,6 +3414,7 @@ async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         f"👤 Your Profile:\n"
         f"⭐ Level: {lvl} ({xp} XP)\n"
+        f"🏅 Rank: #{rank} of {len(xp_board)}\n"
         f"📤 Uploads: {uploads}\n"
         f"📌 Saved: {saved}\n"
         f"📨 Referrals: {refs}\n"
@@ -1024,7 +3430,7 @@ async def share(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = str(update.effective_user.id)
     settings = load_settings()
     
-    if settings["referral_system"]:
+    if settings.referral_system:
         await update.message.reply_text(
             "🎉 Share this bot with your friends and unlock unlimited shuffles!\n\n"
             f"👉 Your referral link:\nhttps://t.me/{context.bot.username}?start={uid}"
@@ -1035,13 +3441,72 @@ async def share(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"👉 Bot link:\nhttps://t.me/{context.bot.username}"
         )
 
+# ===== DISPLAY NAMES =====
+# Admin leaderboards show real names. Names are cached for NAME_TTL and
+# refreshed for free from every update a user sends; missing ones are
+# fetched with get_chat concurrently (at most NAME_FETCHES at a time), and
+# users the bot can no longer see are remembered for NAME_MISS_TTL.
+def display_name(uid, user):
+    name = user.first_name or f"User {uid[-4:]}"
+    if user.username:
+        name += f" (@{user.username})"
+    return name
+
+class NameResolver:
+    def __init__(self):
+        self.names = {}     # uid -> (name or None, expires)
+        self.fetching = {}  # uid -> task, shared by concurrent renders
+        self.semaphore = None  # created on the bot's event loop
+
+    def remember(self, user):
+        uid = str(user.id)
+        self.names[uid] = (display_name(uid, user), time.time() + NAME_TTL)
+
+    async def _fetch(self, bot, uid):
+        async with self.semaphore:
+            try:
+                chat = await bot.get_chat(uid)
+                self.names[uid] = (display_name(uid, chat), time.time() + NAME_TTL)
+            except (Forbidden, BadRequest):
+                self.names[uid] = (None, time.time() + NAME_MISS_TTL)
+            except Exception as e:
+                print(f"Failed to resolve name for {uid}: {e}")  # transient, retried next time
+            finally:
+                self.fetching.pop(uid, None)
+
+    async def resolve(self, bot, uids):
+        """uid -> display name, masked for users that can't be resolved."""
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(NAME_FETCHES)
+        now = time.time()
+        tasks = []
+        for uid in uids:
+            entry = self.names.get(uid)
+            if entry and entry[1] > now:
+                continue
+            if uid not in self.fetching:
+                self.fetching[uid] = asyncio.create_task(self._fetch(bot, uid))
+            tasks.append(self.fetching[uid])
+        if tasks:
+            await asyncio.gather(*tasks)
+        return {uid: (self.names.get(uid) or (None,))[0] or f"User {uid[-4:]}" for uid in uids}
+
+names = NameResolver()
+
+async def user_seen(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user:
+        names.remember(update.effective_user)
+        recipients.revive(update.effective_user.id)
+
 # ===== /LEADERBOARD COMMAND =====
 async def leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if is_admin(update.effective_user.id):
-        # Admin gets choice between all-time and daily leaderboard
+        # Admin gets choice between all-time and daily/weekly/monthly leaderboards
         keyboard = InlineKeyboardMarkup([
             [InlineKeyboardButton("🏆 All Time Top 10", callback_data="leaderboard_alltime")],
-            [InlineKeyboardButton("📅 Today's Top 10", callback_data="leaderboard_daily")]
+            [InlineKeyboardButton("📅 Today's Top 10", callback_data="leaderboard_daily")],
+            [InlineKeyboardButton("📆 This Week's Top 10", callback_data="leaderboard_weekly"),
+             InlineKeyboardButton("🗓️ This Month's Top 10", callback_data="leaderboard_monthly")]
         ])
         await update.message.reply_text(
             "🏆 **Leaderboard Options**\n\nChoose which leaderboard to view:",
@@ -1053,27 +3518,18 @@ async def leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await show_alltime_leaderboard_message(update, context)
 
 async def show_alltime_leaderboard_message(update, context):
-    data = load_data()
-    leaderboard_data = []
+    top10 = repo.top_users(10)
+    viewer_is_admin = is_admin(update.effective_user.id)
 
-    for uid, udata in data['users'].items():
-        leaderboard_data.append((uid, udata['xp']))
-
-    leaderboard_data.sort(key=lambda x: x[1], reverse=True)
-    top10 = leaderboard_data[:10]
+    if viewer_is_admin:
+        # Admin sees actual user names/usernames
+        shown = await names.resolve(context.bot, [uid for uid, _ in top10])
 
     msg = "🏆 All Time Top 10 Users:\n\n"
     for i, (uid, xp) in enumerate(top10, 1):
         lvl = get_level(xp)
-        if is_admin(update.effective_user.id):
-            # Admin sees actual user names/usernames
-            try:
-                user_info = await context.bot.get_chat(uid)
-                name = user_info.first_name or f"User {uid[-4:]}"
-                if user_info.username:
-                    name += f" (@{user_info.username})"
-            except:
-                name = f"User {uid[-4:]}"
+        if viewer_is_admin:
+            name = shown[uid]
         else:
             name = f"User {uid[-4:]}"  # Regular users see masked IDs
         msg += f"{i}. {name} — {xp} XP (Lv{lvl})\n"
@@ -1081,96 +3537,46 @@ async def show_alltime_leaderboard_message(update, context):
     await update.message.reply_text(msg)
 
 async def show_alltime_leaderboard(query, context):
-    data = load_data()
-    leaderboard_data = []
-
-    for uid, udata in data['users'].items():
-        leaderboard_data.append((uid, udata['xp']))
-
-    leaderboard_data.sort(key=lambda x: x[1], reverse=True)
-    top10 = leaderboard_data[:10]
+    top10 = repo.top_users(10)
+    shown = await names.resolve(context.bot, [uid for uid, _ in top10])
 
     msg = "🏆 All Time Top 10 Users:\n\n"
     for i, (uid, xp) in enumerate(top10, 1):
         lvl = get_level(xp)
-        try:
-            user_info = await context.bot.get_chat(uid)
-            name = user_info.first_name or f"User {uid[-4:]}"
-            if user_info.username:
-                name += f" (@{user_info.username})"
-        except:
-            name = f"User {uid[-4:]}"
-        msg += f"{i}. {name} — {xp} XP (Lv{lvl})\n"
+        msg += f"{i}. {shown[uid]} — {xp} XP (Lv{lvl})\n"
 
     await query.edit_message_text(msg)
 
-async def show_daily_leaderboard(query, context):
-    data = load_data()
+async def show_gains_leaderboard(query, context, days, title, period):
     now = time.time()
-    today_start = now - (now % 86400)
-    
-    # Calculate XP gained today for each user
-    daily_xp = []
-    for uid, udata in data['users'].items():
-        # Calculate uploads today
-        today_uploads = sum(1 for t in udata.get('uploaded_at', []) if t >= today_start)
-        upload_xp = today_uploads * 5  # 5 XP per upload
-        
-        # Calculate likes given today (approximate)
-        like_xp = 0
-        for post_id, post in data['posts'].items():
-            if post['timestamp'] >= today_start:
-                if uid in udata.get('liked', []):
-                    like_xp += 1  # 1 XP per like
-        
-        # Calculate comments made today (approximate)
-        comment_xp = 0
-        for post_id, post in data['posts'].items():
-            for comment in post.get('comments', []):
-                if comment['user'] == uid and comment.get('timestamp', 0) >= today_start:
-                    comment_xp += 1  # 1 XP per comment
-        
-        # Calculate XP from likes/dislikes received today
-        received_xp = 0
-        for post_id in udata.get('uploads', []):
-            if post_id in data['posts']:
-                post = data['posts'][post_id]
-                if post['timestamp'] >= today_start:
-                    received_xp += (post['likes'] + post['dislikes']) * 2  # 2 XP per like/dislike received
-        
-        total_daily_xp = upload_xp + like_xp + comment_xp + received_xp
-        
-        if total_daily_xp > 0:
-            daily_xp.append((uid, total_daily_xp))
-    
-    daily_xp.sort(key=lambda x: x[1], reverse=True)
-    top10_daily = daily_xp[:10]
-    
-    if not top10_daily:
-        await query.edit_message_text("📅 No activity today yet!")
+    since = now - (now % 86400) - (days - 1) * 86400
+    top10 = repo.top_xp_gains(since, now, 10)
+
+    if not top10:
+        await query.edit_message_text(f"📅 No activity {period} yet!")
         return
-    
-    msg = "📅 Today's Top 10 Users (XP gained today):\n\n"
-    for i, (uid, daily_xp_gained) in enumerate(top10_daily, 1):
-        try:
-            user_info = await context.bot.get_chat(uid)
-            name = user_info.first_name or f"User {uid[-4:]}"
-            if user_info.username:
-                name += f" (@{user_info.username})"
-        except:
-            name = f"User {uid[-4:]}"
-        msg += f"{i}. {name} — +{daily_xp_gained} XP today\n"
-    
+
+    shown = await names.resolve(context.bot, [uid for uid, _ in top10])
+
+    msg = f"{title}\n\n"
+    for i, (uid, xp_gained) in enumerate(top10, 1):
+        msg += f"{i}. {shown[uid]} — +{xp_gained} XP {period}\n"
+
     await query.edit_message_text(msg)
 
+async def show_daily_leaderboard(query, context):
+    await show_gains_leaderboard(query, context, 1, "📅 Today's Top 10 Users (XP gained today):", "today")
+
+async def show_weekly_leaderboard(query, context):
+    await show_gains_leaderboard(query, context, 7, "📆 This Week's Top 10 Users (last 7 days):", "this week")
+
+async def show_monthly_leaderboard(query, context):
+    await show_gains_leaderboard(query, context, 30, "🗓️ This Month's Top 10 Users (last 30 days):", "this month")
+
 # ===== /DELETE COMMAND =====
 async def delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = str(update.effective_user.id)
-    data = load_data()
-
-    initialize_user(uid, data)
-
-    posts = data['users'][uid]['uploads']
+    posts = repo.ensure_user(uid)['uploads']
 
     if not posts:
         await update.message.reply_text("❌ You have no uploads.")
@@ -1185,16 +3591,20 @@ async def delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def delete_button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     uid = str(query.from_user.id)
-    data = load_data()
     await query.answer()
 
     if "|" in query.data:
         _, pid = query.data.split("|")
-        if pid in data['posts'] and data['posts'][pid]['uploader'] == uid:
-            del data['posts'][pid]
-            data['users'][uid]['uploads'].remove(pid)
-            await query.edit_message_text("✅ Post deleted.")
-            save_data(data)
+        async with transaction(uid, pid):
+            post = repo.post(pid)
+            deleted = post and post['uploader'] == uid
+            if deleted:
+                repo.delete_post(pid)
+        if deleted:
+            if await repo.flush():
+                await query.edit_message_text("✅ Post deleted.")
+            else:
+                await query.edit_message_text("⚠️ Post deleted, but saving is delayed. It will be stored once the disk recovers.")
         else:
             await query.edit_message_text("❌ Cannot delete this post.")
 
@@ -1209,14 +3619,8 @@ async def make_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     target_uid = context.args[0]
-    data = load_data()
-    
-    if 'admins' not in data:
-        data['admins'] = []
     
-    if target_uid not in data['admins']:
-        data['admins'].append(target_uid)
-        save_data(data)
+    if repo.add_admin(target_uid):
         await update.message.reply_text(f"✅ User {target_uid} is now an admin!")
         try:
             await context.bot.send_message(target_uid, "🎉 You have been promoted to admin!")
@@ -1231,30 +3635,18 @@ async def ban(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Only admin can use this.")
         return
 
-    data = load_data()
-
     # Check if replying to a message (ban by reply)
     if update.message.reply_to_message:
         # Extract post ID from the replied message caption or use message info
         replied_msg = update.message.reply_to_message
         if replied_msg.photo and replied_msg.caption:
-            # Find the post by searching through all posts
-            target_uid = None
-            for pid, post_data in data['posts'].items():
-                if post_data['file_id'] == replied_msg.photo[-1].file_id:
-                    target_uid = post_data['uploader']
-                    break
+            # Find the post by its file_id
+            target_uid = repo.uploader_of_file(replied_msg.photo[-1].file_id)
 
             if target_uid:
-                initialize_user(target_uid, data)
-                data['users'][target_uid]['banned'] = True
-                # Remove all posts by this user
-                posts_to_remove = [pid for pid, post in data['posts'].items() if post['uploader'] == target_uid]
-                for pid in posts_to_remove:
-                    del data['posts'][pid]
-                data['users'][target_uid]['uploads'] = []
-                save_data(data)
-                await update.message.reply_text(f"🚫 User {target_uid} banned and all their posts removed.")
+                repo.ensure_user(target_uid)
+                repo.ban(target_uid)
+                await reply_banned(update, target_uid)
             else:
                 await update.message.reply_text("❌ Could not identify the post uploader.")
         else:
@@ -1266,15 +3658,15 @@ async def ban(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Usage: /ban <user_id> or reply to a post to ban the uploader")
         return
     uid = context.args[0]
-    initialize_user(uid, data)
-    data['users'][uid]['banned'] = True
-    # Remove all posts by this user
-    posts_to_remove = [pid for pid, post in data['posts'].items() if post['uploader'] == uid]
-    for pid in posts_to_remove:
-        del data['posts'][pid]
-    data['users'][uid]['uploads'] = []
-    save_data(data)
-    await update.message.reply_text(f"🚫 User {uid} banned and all their posts removed.")
+    repo.ensure_user(uid)
+    repo.ban(uid)
+    await reply_banned(update, uid)
+
+async def reply_banned(update, uid):
+    if await repo.flush():
+        await update.message.reply_text(f"🚫 User {uid} banned and all their posts removed.")
+    else:
+        await update.message.reply_text(f"⚠️ User {uid} banned, but saving is delayed. It will be stored once the disk recovers.")
 
 async def unban(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
@@ -1284,10 +3676,8 @@ async def unban(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Usage: /unban <user_id>")
         return
     uid = context.args[0]
-    data = load_data()
-    initialize_user(uid, data)
-    data['users'][uid]['banned'] = False
-    save_data(data)
+    repo.ensure_user(uid)
+    repo.set_user(uid, 'banned', False)
     await update.message.reply_text(f"✅ User {uid} unbanned.")
 
 # ===== /VERIFY =====
@@ -1299,9 +3689,8 @@ async def verify(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Usage: /verify <user_id>")
         return
     uid = context.args[0]
-    data = load_data()
-    initialize_user(uid, data)
-    data['users'][uid]['is_verified'] = True
+    repo.ensure_user(uid)
+    repo.set_user(uid, 'is_verified', True)
 
     # Send notification to the user
     try:
@@ -1309,63 +3698,109 @@ async def verify(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         print(f"Failed to send verification message to user {uid}: {e}")
 
-    save_data(data)
     await update.message.reply_text(f"✅ User {uid} verified.")
 
 # ===== /TRENDING =====
 async def trending(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    data = load_data()
-    sorted_posts = sorted(data['posts'].items(), key=lambda x: x[1]['likes'], reverse=True)[:5]
+    page = int(context.args[0]) if context.args and context.args[0].isdigit() else 1
+    await send_trending(context.bot, update.effective_chat.id, max(1, page))
+
+async def send_trending(bot, chat_id, page):
+    sorted_posts, total = repo.trending_posts((page - 1) * TRENDING_PAGE, TRENDING_PAGE)
 
     if not sorted_posts:
-        await update.message.reply_text("📭 No trending posts.")
+        await bot.send_message(chat_id, "📭 No trending posts." if page == 1 else "📭 No more trending posts.")
         return
 
-    for pid, post in sorted_posts:
-        uploader_data = data['users'].get(post['uploader'], {})
-        uploader_level = get_level(uploader_data.get('xp', 0))
-        verified_badge = "✅" if uploader_data.get("is_verified") else ""
-        await update.message.reply_photo(
-            post['file_id'], 
-            caption=f"🔥 Trending — 👍🏻 {post['likes']} | 👤 Anonymous (Lv{uploader_level}){verified_badge}"
+    for i, (pid, post) in enumerate(sorted_posts):
+        caption, _ = render_post("trending", pid, post)
+        more = page * TRENDING_PAGE < total and i == len(sorted_posts) - 1
+        await bot.send_photo(
+            chat_id,
+            post['file_id'],
+            caption=caption,
+            reply_markup=InlineKeyboardMarkup([[
+                InlineKeyboardButton("More ▶", callback_data=f"trending_page|{page + 1}")]]) if more else None
         )
 
+# ===== PAGED GALLERIES =====
+# Saved posts and the profile's Today's / Top 10 lists are sent a page at a
+# time: one media group of up to GALLERY_PAGE photos plus a footer message
+# whose "More ▶" button carries the next offset (gallery|<kind>|<offset>).
+# Media groups can't carry buttons, so the saved gallery's footer also has
+# numbered Like / Comment buttons for each photo on the page. Each page
+# costs two API calls however long the list is.
+GALLERY_PAGE = 10  # Telegram's media group limit
+
+def saved_gallery(uid, offset, limit):
+    return repo.saved_posts(uid, offset, limit)
+
+def today_gallery(uid, offset, limit):
+    now = time.time()
+    today_start = now - (now % 86400)
+    posts = [(pid, post) for pid, post in repo.posts_by_uploader(uid) if post['timestamp'] >= today_start]
+    return posts[offset:offset + limit], len(posts)
+
+def top_gallery(uid, offset, limit):
+    posts = sorted(repo.posts_by_uploader(uid), key=lambda item: item[1]['likes'], reverse=True)[:10]
+    return posts[offset:offset + limit], len(posts)
+
+def top_caption(rank, pid, post):
+    return f"🏆 #{rank} Your Top Post\n👍🏻 {post['likes']} likes | 👎🏻 {post['dislikes']}\n{post_badge(post['uploader'])}"
+
+GALLERIES = {
+    "saved": ("📌 Saved posts", saved_gallery, lambda rank, pid, post: f"#{rank} " + render_post("saved", pid, post)[0]),
+    "today": ("📅 Today's posts", today_gallery, lambda rank, pid, post: render_post("today", pid, post)[0]),
+    "top": ("🏆 Your top posts", top_gallery, top_caption),
+}
+
+async def send_gallery(bot, uid, kind, offset):
+    """Send one page of a gallery to uid; False if there is nothing to show."""
+    title, load, caption = GALLERIES[kind]
+    posts, total = load(uid, offset, GALLERY_PAGE)
+    if not posts:
+        return False
+    media = [InputMediaPhoto(post['file_id'], caption=caption(offset + i, pid, post))
+             for i, (pid, post) in enumerate(posts, 1)]
+    if len(media) == 1:
+        await bot.send_photo(uid, media[0].media, caption=media[0].caption)
+    else:
+        await bot.send_media_group(uid, media)
+    end = offset + len(posts)
+    rows = gallery_actions(posts, offset) if kind == "saved" else []
+    if end < total:
+        rows.append([InlineKeyboardButton("More ▶", callback_data=f"gallery|{kind}|{end}")])
+    await bot.send_message(uid, f"{title} {offset + 1}–{end} of {total}",
+                           reply_markup=InlineKeyboardMarkup(rows) if rows else None)
+    return True
+
+def gallery_actions(posts, offset):
+    """Numbered Like / Comment buttons, two photos per row."""
+    buttons = []
+    for rank, (pid, _) in enumerate(posts, offset + 1):
+        buttons += [InlineKeyboardButton(f"#{rank} 👍🏻", callback_data=f"like|{pid}"),
+                    InlineKeyboardButton(f"#{rank} 💬", callback_data=f"comment|{pid}")]
+    return [buttons[i:i + 4] for i in range(0, len(buttons), 4)]
+
+async def gallery_more(query, context):
+    _, kind, offset = query.data.split("|")
+    message = query.message
+    # One press per More button; the page's action buttons stay
+    rows = message.reply_markup.inline_keyboard[:-1] if message is not None and message.is_accessible and message.reply_markup else ()
+    try:
+        await query.edit_message_reply_markup(InlineKeyboardMarkup(rows) if rows else None)
+    except TelegramError:
+        pass
+    if not await send_gallery(context.bot, str(query.from_user.id), kind, int(offset)):
+        await context.bot.send_message(query.from_user.id, "📭 No more posts.")
+
 # ===== /SAVED POSTS =====
 async def view_saved(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = str(update.effective_user.id)
-    data = load_data()
-
-    initialize_user(uid, data)
-
-    saved = data['users'][uid].get('saved', [])
+    repo.ensure_user(uid)
 
-    if not saved:
+    if not await send_gallery(context.bot, uid, "saved", 0):
         await update.message.reply_text("📭 No saved posts.")
-        return
-
-    await update.message.reply_text(f"📌 Your Saved Posts ({len(saved)} total):")
-    
-    # Send all saved posts
-    for pid in saved:
-        if pid in data['posts']:
-            post = data['posts'][pid]
-            uploader_data = data['users'].get(post['uploader'], {})
-            uploader_level = get_level(uploader_data.get('xp', 0))
-            verified_badge = "✅" if uploader_data.get("is_verified") else ""
-            
-            keyboard = InlineKeyboardMarkup([
-                [InlineKeyboardButton("👍🏻 Like", callback_data=f"like|{pid}"),
-                 InlineKeyboardButton("👎🏻 Dislike", callback_data=f"dislike|{pid}")],
-                [InlineKeyboardButton("💬 Comment", callback_data=f"comment|{pid}"),
-                 InlineKeyboardButton("🚫 Report", callback_data=f"report|{pid}")]
-            ])
-            
-            await context.bot.send_photo(
-                uid,
-                post['file_id'], 
-                caption=f"📌 Saved Post\n👍🏻 {post['likes']} | 👎🏻 {post['dislikes']}\n👤 Anonymous (Lv{uploader_level}){verified_badge}",
-                reply_markup=keyboard
-            )
 
 # ===== /COMMENTS =====
 async def view_comments(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1373,8 +3808,7 @@ async def view_comments(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Usage: /comments <post_id>")
         return
     pid = context.args[0]
-    data = load_data()
-    post = data['posts'].get(pid)
+    post = repo.post(pid)
     if not post:
         await update.message.reply_text("❌ Post not found.")
         return
@@ -1393,9 +3827,7 @@ async def view_reports(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Admin only.")
         return
 
-    data = load_data()
-    reported = [(pid, len(post['reported_by'])) for pid, post in data['posts'].items() if post['reported_by']]
-    reported.sort(key=lambda x: x[1], reverse=True)
+    reported = repo.reported_posts()
 
     if not reported:
         await update.message.reply_text("✅ No reported posts.")
@@ -1404,11 +3836,7 @@ async def view_reports(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(f"🚨 Found {len(reported)} reported posts. Sending them now...")
     
     for pid, count in reported[:10]:
-        post = data['posts'][pid]
-        uploader_data = data['users'].get(post['uploader'], {})
-        uploader_level = get_level(uploader_data.get('xp', 0))
-        verified_badge = "✅" if uploader_data.get("is_verified") else ""
-        
+        post = repo.post(pid)
         keyboard = InlineKeyboardMarkup([
             [InlineKeyboardButton("🗑️ Delete Post", callback_data=f"admin_delete|{pid}"),
              InlineKeyboardButton("❌ Ignore Report", callback_data=f"ignore_report|{pid}")],
@@ -1422,7 +3850,7 @@ async def view_reports(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     f"📝 Post ID: {pid}\n"
                     f"👤 Uploader: User {post['uploader'][-4:]}\n"
                     f"👍🏻 {post['likes']} | 👎🏻 {post['dislikes']}\n"
-                    f"👤 Anonymous (Lv{uploader_level}){verified_badge}",
+                    f"{post_badge(post['uploader'])}",
             reply_markup=keyboard
         )
 
@@ -1432,46 +3860,24 @@ async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Only admin can use this.")
         return
 
-    data = load_data()
     settings = load_settings()
-    total_users = len(data['users'])
-    total_posts = len(data['posts'])
-    total_uploads = sum(len(user.get('uploads', [])) for user in data['users'].values())
-    verified_users = sum(1 for user in data['users'].values() if user.get('is_verified', False))
-    banned_users = sum(1 for user in data['users'].values() if user.get('banned', False))
-
-    # Recent activity (last 24 hours)
-    now = time.time()
-    recent_uploads = sum(
-        len([t for t in user.get('uploaded_at', []) if now - t < 86400])
-        for user in data['users'].values()
-    )
-
-    # Active users (last 24 hours)
-    active_users = sum(
-        1 for user in data['users'].values()
-        if any(now - t < 86400 for t in user.get('uploaded_at', []))
-    )
-
-    # Most reported posts
-    reported_posts = [(pid, len(post['reported_by'])) for pid, post in data['posts'].items() if post['reported_by']]
-    reported_posts.sort(key=lambda x: x[1], reverse=True)
+    stats = repo.stats(time.time())
 
     await update.message.reply_text(
         f"📊 **Admin Dashboard**\n\n"
-        f"👥 Total Users: {total_users}\n"
-        f"📤 Total Posts: {total_posts}\n"
-        f"📸 Total Uploads: {total_uploads}\n"
-        f"✅ Verified Users: {verified_users}\n"
-        f"🚫 Banned Users: {banned_users}\n"
-        f"📈 Recent Uploads (24h): {recent_uploads}\n"
-        f"🟢 Active Users (24h): {active_users}\n"
-        f"🚨 Reported Posts: {len(reported_posts)}\n\n"
+        f"👥 Total Users: {stats['total_users']}\n"
+        f"📤 Total Posts: {stats['total_posts']}\n"
+        f"📸 Total Uploads: {stats['total_uploads']}\n"
+        f"✅ Verified Users: {stats['verified_users']}\n"
+        f"🚫 Banned Users: {stats['banned_users']}\n"
+        f"📈 Recent Uploads (24h): {stats['recent_uploads']}\n"
+        f"🟢 Active Users (24h): {stats['active_users']}\n"
+        f"🚨 Reported Posts: {stats['reported_posts']}\n\n"
         f"**Current Settings:**\n"
-        f"🔗 Referral System: {'ON' if settings['referral_system'] else 'OFF'}\n"
-        f"📤 Upload Limit: {settings['upload_limit']}/hour\n"
-        f"🔁 Shuffle Limit: {settings['shuffle_limit']}\n"
-        f"💬 Comment Alerts: {'ON' if settings['comment_notifications'] else 'OFF'}\n\n"
+        f"🔗 Referral System: {'ON' if settings.referral_system else 'OFF'}\n"
+        f"📤 Upload Limit: {settings.upload_limit}/hour\n"
+        f"🔁 Shuffle Limit: {settings.shuffle_limit}\n"
+        f"💬 Comment Alerts: {'ON' if settings.comment_notifications else 'OFF'}\n\n"
         f"**Admin Powers:**\n"
         f"• Unlimited uploads & shuffles\n"
         f"• Auto-delete posts when reporting\n"
@@ -1479,86 +3885,195 @@ async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"• Use /adminpanel to change settings",
         parse_mode='Markdown'
     )
+    latency = metrics.report()
+    if latency:
+        await update.message.reply_text(f"⏱️ Metrics:\n{latency}")
+
+# ===== /BROADCAST =====
+# Admin broadcasts walk the user list in chunks through the bulk lane of the
+# outbound scheduler, BROADCAST_WORKERS sends at a time. Progress is
+# checkpointed to broadcast.json (the cursor of the last user before which
+# everything was handled), so a restart resumes there; at most the sends in
+# flight at the crash are repeated. The admin's status message shows
+# throughput, failures and ETA.
+BROADCAST_CHUNK = 500
+BROADCAST_PROGRESS_INTERVAL = 10  # seconds between status edits / checkpoints
+
+class Broadcaster:
+    def __init__(self, path):
+        self.path = path
+        self.state = None
+        self.task = None
+
+    def load(self):
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    self.state = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Ignoring unreadable {self.path}: {e}")
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmp, self.path)
+
+    @property
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+    def start(self, bot, message, status):
+        self.state = {
+            "message": message,  # {"text": ...} or {"from_chat_id": ..., "message_id": ...}
+            "status": [status.chat_id, status.message_id],
+            "cursor": 0, "sent": 0, "failed": 0,
+            "total": repo.user_count(), "started": time.time(), "finished": None,
+        }
+        self.save()
+        self.task = asyncio.create_task(self.run(bot))
+
+    def resume(self, bot):
+        if self.state and not self.state['finished']:
+            self.task = asyncio.create_task(self.run(bot))
+
+    def stop(self):
+        if self.running:
+            self.task.cancel()
+
+    def cancel(self):
+        """Stop for good: unlike a shutdown, a cancelled broadcast is not resumed."""
+        self.stop()
+        self.state['finished'] = time.time()
+        self.save()
+
+    async def send(self, bot, uid):
+        message = self.state['message']
+        if 'text' in message:
+            return await notify(bot.send_message, uid, message['text'], lane=LANE_BULK)
+        return await notify(bot.copy_message, uid, message['from_chat_id'], message['message_id'], lane=LANE_BULK)
+
+    async def run(self, bot):
+        state = self.state
+        session_start, session_done = time.monotonic(), state['sent'] + state['failed']
+        reported = time.monotonic()
+        try:
+            while True:
+                page = repo.user_page(state['cursor'], BROADCAST_CHUNK)
+                if not page:
+                    break
+                done, mark = set(), 0
+                pending = iter(enumerate(page))
+
+                async def worker():
+                    nonlocal reported, mark
+                    for i, (cursor, uid) in pending:
+                        if await self.send(bot, uid):
+                            state['sent'] += 1
+                        else:
+                            state['failed'] += 1
+                        done.add(i)
+                        while mark in done:  # advance the checkpoint over the finished prefix
+                            state['cursor'] = page[mark][0]
+                            mark += 1
+                        if time.monotonic() - reported >= BROADCAST_PROGRESS_INTERVAL:
+                            reported = time.monotonic()
+                            self.save()
+                            await self.report(bot, session_start, session_done)
+
+                await asyncio.gather(*(worker() for _ in range(BROADCAST_WORKERS)))
+                state['cursor'] = page[-1][0]
+                self.save()
+            state['finished'] = time.time()
+            self.save()
+        finally:
+            self.save()
+        await self.report(bot, session_start, session_done)
+
+    async def report(self, bot, session_start, session_done):
+        state = self.state
+        handled = state['sent'] + state['failed']
+        rate = (handled - session_done) / max(time.monotonic() - session_start, 1e-6)
+        remaining = max(state['total'] - handled, 0)
+        if state['finished']:
+            text = (f"📢 Broadcast finished in {format_duration(state['finished'] - state['started'])}\n"
+                    f"✅ Sent: {state['sent']} | ❌ Failed: {state['failed']}")
+        else:
+            eta = format_duration(remaining / rate) if rate > 0 else "?"
+            text = (f"📢 Broadcasting… {handled}/{state['total']}\n"
+                    f"✅ Sent: {state['sent']} | ❌ Failed: {state['failed']}\n"
+                    f"⚡ {rate:.1f} msg/s | ⏳ ETA {eta}")
+        chat_id, message_id = state['status']
+        try:
+            await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id)
+        except TelegramError:
+            pass
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h {seconds % 3600 // 60}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m {seconds % 60}s"
+    return f"{seconds}s"
+
+broadcaster = Broadcaster(BROADCAST_FILE)
+
+async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ Only admin can use this.")
+        return
+
+    if context.args == ["cancel"]:
+        if broadcaster.running:
+            broadcaster.cancel()
+            state = broadcaster.state
+            await update.message.reply_text(
+                f"🛑 Broadcast cancelled after {state['sent'] + state['failed']}/{state['total']} users.")
+        else:
+            await update.message.reply_text("❌ No broadcast is running.")
+        return
+
+    if broadcaster.running:
+        await update.message.reply_text("⏳ A broadcast is already running. Use /broadcast cancel to stop it.")
+        return
+
+    replied = update.message.reply_to_message
+    if replied:
+        message = {"from_chat_id": replied.chat_id, "message_id": replied.message_id}
+    elif context.args:
+        message = {"text": update.message.text.split(None, 1)[1]}
+    else:
+        await update.message.reply_text("Usage: /broadcast <message>, or reply to a message with /broadcast")
+        return
+
+    status = await update.message.reply_text(f"📢 Broadcast to {repo.user_count()} users starting…")
+    broadcaster.start(context.bot, message, status)
 
 # ===== PROFILE BUTTON HANDLERS =====
 async def handle_profile_buttons(query, context: ContextTypes.DEFAULT_TYPE):
     uid = str(query.from_user.id)
-    data = load_data()
     action, target_uid = query.data.split("|")
     
     if uid != target_uid:
         await query.answer("❌ You can only view your own profile data.")
         return
 
-    user_data = data['users'].get(uid, {})
-    
     if action == "top_posts":
-        # Get user's own posts and sort by likes
-        user_posts = []
-        for post_id in user_data.get('uploads', []):
-            if post_id in data['posts']:
-                post = data['posts'][post_id]
-                user_posts.append((post_id, post['likes'], post))
-        
-        # Sort by likes (descending) and get top 10
-        user_posts.sort(key=lambda x: x[1], reverse=True)
-        top_posts = user_posts[:10]
-        
-        if not top_posts:
+        if not await send_gallery(context.bot, uid, "top", 0):
             await query.answer("📭 No posts found.")
-            return
-            
-        await query.answer("🏆 Showing your top 10 posts...")
-        for i, (post_id, likes, post) in enumerate(top_posts, 1):
-            uploader_level = get_level(user_data.get('xp', 0))
-            verified_badge = "✅" if user_data.get("is_verified") else ""
-            
-            await context.bot.send_photo(
-                uid,
-                post['file_id'],
-                caption=f"🏆 #{i} Your Top Post\n👍🏻 {likes} likes | 👎🏻 {post['dislikes']}\n👤 Anonymous (Lv{uploader_level}){verified_badge}"
-            )
-    
+
     elif action == "today_posts":
-        now = time.time()
-        today_start = now - (now % 86400)
-        
-        today_uploads = []
-        for post_id in user_data.get('uploads', []):
-            if post_id in data['posts']:
-                post = data['posts'][post_id]
-                if post['timestamp'] >= today_start:
-                    today_uploads.append((post_id, post['timestamp']))
-        
-        if not today_uploads:
+        if not await send_gallery(context.bot, uid, "today", 0):
             await query.answer("📅 No posts today.")
-            return
-            
-        await query.answer("📅 Showing today's posts...")
-        for post_id, upload_time in today_uploads:
-            post = data['posts'][post_id]
-            time_str = time.strftime("%H:%M", time.localtime(upload_time))
-            uploader_level = get_level(user_data.get('xp', 0))
-            verified_badge = "✅" if user_data.get("is_verified") else ""
-            await context.bot.send_photo(
-                uid,
-                post['file_id'],
-                caption=f"📅 Posted today at {time_str}\n👍🏻 {post['likes']} | 👎🏻 {post['dislikes']} | 💬 {len(post.get('comments', []))}\n👤 Anonymous (Lv{uploader_level}){verified_badge}"
-            )
 
 # ===== ANONYMOUS MESSAGE HANDLERS =====
 async def handle_anonymous_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = str(update.effective_user.id)
-    data = load_data()
     message_text = update.message.text
     
-    # Find eligible users for anonymous chat
-    eligible_users = []
-    for user_id, user_data in data['users'].items():
-        if (user_id != uid and 
-            user_data.get('anonymous_receive', True) and 
-            not user_data.get('anon_conversation')):  # Not in conversation
-            eligible_users.append(user_id)
+    # Find eligible users for anonymous chat (not already in a conversation, still reachable)
+    eligible_users = [u for u in repo.anon_candidates(uid) if recipients.alive(u)]
     
     if not eligible_users:
         await update.message.reply_text(
@@ -1570,86 +4085,81 @@ async def handle_anonymous_message(update: Update, context: ContextTypes.DEFAULT
     import random
     target_user = random.choice(eligible_users)
     
-    # Set up conversation
-    data['users'][uid]['anon_conversation'] = target_user
-    data['users'][target_user]['anon_conversation'] = uid
-    
-    # Store message for cleanup (delete after 1 day)
-    import time
-    message_data = {
-        'from': uid,
-        'to': target_user,
-        'message': message_text,
-        'timestamp': time.time()
-    }
-    
-    # Initialize anon_messages if not exists
-    if 'anon_messages' not in data:
-        data['anon_messages'] = []
+    # Both sides of the pairing change together, so hold both users while
+    # pairing; the sends happen after the locks are released
+    async with transaction(uid, users=(target_user,)):
+        busy = bool((repo.user(target_user) or {}).get('anon_conversation'))
+        if not busy:
+            # Set up conversation
+            repo.set_user(uid, 'anon_conversation', target_user)
+            repo.set_user(target_user, 'anon_conversation', uid)
+            
+            # Store message for cleanup (delete after 1 day)
+            repo.anon_message(uid, target_user, message_text, time.time())
+
+    if busy:
+        await update.message.reply_text("😔 That user just started another chat. Try again!")
+        del context.user_data['anon_chat_mode']
+        return
     
-    data['anon_messages'].append(message_data)
+    # Send to target user
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton("🔁 Reply", callback_data=f"anon_reply_conv|{uid}")]
+    ])
     
-    # Clean old messages (older than 1 day)
-    now = time.time()
-    one_day_ago = now - 86400
-    data['anon_messages'] = [msg for msg in data['anon_messages'] if msg['timestamp'] > one_day_ago]
+    sent = await notify(
+        context.bot.send_message,
+        target_user,
+        f"💭 **Anonymous Message**\n\n{message_text}\n\n_Someone wants to chat anonymously!_",
+        reply_markup=keyboard,
+        parse_mode='Markdown'
+    )
     
-    # Send to target user
-    try:
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("🔁 Reply", callback_data=f"anon_reply_conv|{uid}")]
-        ])
-        
-        await context.bot.send_message(
-            target_user,
-            f"💭 **Anonymous Message**\n\n{message_text}\n\n_Someone wants to chat anonymously!_",
-            reply_markup=keyboard,
-            parse_mode='Markdown'
-        )
-        
+    if sent:
         await update.message.reply_text(
             "✅ Anonymous message sent! If they reply, you'll get notified.\n\n"
             "💭 Send another message to continue the conversation, or type /stop to end it."
         )
-        
-    except Exception as e:
-        # If sending fails, clean up conversation
-        data['users'][uid]['anon_conversation'] = None
-        data['users'][target_user]['anon_conversation'] = None
+    else:
+        # If sending fails, clean up conversation unless either side moved on meanwhile
+        async with transaction(uid, users=(target_user,)):
+            if (repo.user(uid) or {}).get('anon_conversation') == target_user:
+                repo.set_user(uid, 'anon_conversation', None)
+            if (repo.user(target_user) or {}).get('anon_conversation') == uid:
+                repo.set_user(target_user, 'anon_conversation', None)
         await update.message.reply_text("❌ Failed to send message. Try again later.")
     
     del context.user_data['anon_chat_mode']
 
 async def handle_anonymous_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = str(update.effective_user.id)
-    data = load_data()
     message_text = update.message.text
     target_user = context.user_data['anon_reply_target']
     
     # Check if target user exists and initialize if needed
-    initialize_user(target_user, data)
+    target_data = repo.ensure_user(target_user)
     
     # Check if target user has anonymous chat enabled
-    if not data['users'].get(target_user, {}).get('anonymous_receive', True):
+    if not target_data.get('anonymous_receive', True):
         await update.message.reply_text("❌ That user has disabled anonymous messages.")
         del context.user_data['anon_reply_target']
         return
     
-    try:
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("🔁 Reply", callback_data=f"anon_reply|{uid}")]
-        ])
-        
-        await context.bot.send_message(
-            target_user,
-            f"💭 **Anonymous Reply**\n\n{message_text}\n\n_Anonymous reply to your comment_",
-            reply_markup=keyboard,
-            parse_mode='Markdown'
-        )
-        
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton("🔁 Reply", callback_data=f"anon_reply|{uid}")]
+    ])
+    
+    sent = await notify(
+        context.bot.send_message,
+        target_user,
+        f"💭 **Anonymous Reply**\n\n{message_text}\n\n_Anonymous reply to your comment_",
+        reply_markup=keyboard,
+        parse_mode='Markdown'
+    )
+    
+    if sent:
         await update.message.reply_text("✅ Anonymous reply sent!")
-        
-    except:
+    else:
         await update.message.reply_text("❌ Failed to send reply. User may have blocked the bot.")
     
     del context.user_data['anon_reply_target']
@@ -1675,15 +4185,10 @@ async def handle_anon_chat(query, context: ContextTypes.DEFAULT_TYPE):
 
 async def handle_anon_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = str(update.effective_user.id)
-    data = load_data()
     message_text = update.message.text
     
-    # Initialize anonymous messages if not exists
-    if 'anon_messages' not in data:
-        data['anon_messages'] = {}
-    
-    # Find a random user to send message to (exclude self)
-    all_users = [u for u in data['users'].keys() if u != uid]
+    # Find a random user to send message to (exclude self and chats that blocked the bot)
+    all_users = [u for u, _ in repo.users() if u != uid and recipients.alive(u)]
     if not all_users:
         await update.message.reply_text("❌ No other users to send message to.")
         del context.user_data['anon_chat']
@@ -1693,44 +4198,34 @@ async def handle_anon_message(update: Update, context: ContextTypes.DEFAULT_TYPE
     target_user = random.choice(all_users)
 
     # Store the message
-    if target_user not in data['anon_messages']:
-        data['anon_messages'][target_user] = []
-    
-    data['anon_messages'][target_user].append({
-        'message': message_text,
-        'timestamp': time.time()
-    })
+    repo.anon_message(uid, target_user, message_text, time.time())
     
     # Send confirmation to sender
     await update.message.reply_text("✅ Anonymous message sent to a random user!")
     
     # Notify recipient
-    try:
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("💭 Reply Anonymously", callback_data="reply_anon")],
-            [InlineKeyboardButton("📨 Check All Messages", callback_data="check_anon_msg")]
-        ])
-        
-        await context.bot.send_message(
-            target_user,
-            f"💭 **Anonymous Message**\n\n{message_text}\n\n_Someone sent you this anonymously!_",
-            reply_markup=keyboard,
-            parse_mode='Markdown'
-        )
-    except:
-        pass  # User might have blocked the bot
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton("💭 Reply Anonymously", callback_data="reply_anon")],
+        [InlineKeyboardButton("📨 Check All Messages", callback_data="check_anon_msg")]
+    ])
+    
+    await notify(
+        context.bot.send_message,
+        target_user,
+        f"💭 **Anonymous Message**\n\n{message_text}\n\n_Someone sent you this anonymously!_",
+        reply_markup=keyboard,
+        parse_mode='Markdown'
+    )
     
     del context.user_data['anon_chat']
 
 # ===== ANONYMOUS CHAT HANDLER =====
 async def anonymous_chat_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = str(update.effective_user.id)
-    data = load_data()
-    
-    initialize_user(uid, data)
+    user_data = repo.ensure_user(uid)
     
     # Check if user has anonymous chat enabled
-    if not data['users'][uid].get('anonymous_receive', True):
+    if not user_data.get('anonymous_receive', True):
         await update.message.reply_text(
             "🔒 Anonymous chat is disabled for you. Enable it in your profile settings to use this feature."
         )
@@ -1748,12 +4243,12 @@ async def profile_update_after_toggle(query, context: ContextTypes.DEFAULT_TYPE)
     """Update profile message after toggling settings"""
     user = query.from_user
     uid = str(user.id)
-    data = load_data()
-    udata = data['users'].get(uid, {})
+    udata = repo.user(uid) or {}
 
     uploads = len(udata.get('uploads', []))
     xp = udata.get('xp', 0)
     lvl = get_level(xp)
+    rank = xp_board.rank(uid)
     refs = udata.get('referrals', 0)
     saved = len(udata.get("saved", []))
     verified = "✅" if udata.get("is_verified") else "❌"
@@ -1779,6 +4274,7 @@ async def profile_update_after_toggle(query, context: ContextTypes.DEFAULT_TYPE)
         await query.edit_message_text(
             f"👤 Your Profile:\n"
             f"⭐ Level: {lvl} ({xp} XP)\n"
+            f"🏅 Rank: #{rank} of {len(xp_board)}\n"
             f"📤 Uploads: {uploads}\n"
             f"📌 Saved: {saved}\n"
             f"📨 Referrals: {refs}\n"
@@ -1794,12 +4290,7 @@ async def profile_update_after_toggle(query, context: ContextTypes.DEFAULT_TYPE)
 # ===== CHECK CHANNEL MEMBERSHIP =====
 async def check_anonymous_messages(query, context: ContextTypes.DEFAULT_TYPE):
     uid = str(query.from_user.id)
-    data = load_data()
-    
-    if 'anon_messages' not in data:
-        data['anon_messages'] = {}
-    
-    user_messages = data['anon_messages'].get(uid, [])
+    user_messages = repo.anon_inbox(uid)
     
     if not user_messages:
         await query.answer("📭 No anonymous messages.")
@@ -1836,25 +4327,21 @@ async def check_channel_membership(context: ContextTypes.DEFAULT_TYPE, user_id:
 # ===== /STOP COMMAND =====
 async def stop_anonymous_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = str(update.effective_user.id)
-    data = load_data()
-    
-    initialize_user(uid, data)
-    
-    conversation_partner = data['users'][uid].get('anon_conversation')
+    conversation_partner = repo.ensure_user(uid).get('anon_conversation')
     
     if conversation_partner:
         # End conversation for both users
-        data['users'][uid]['anon_conversation'] = None
-        if conversation_partner in data['users']:
-            data['users'][conversation_partner]['anon_conversation'] = None
-            try:
-                await context.bot.send_message(
-                    conversation_partner,
-                    "💭 Anonymous conversation ended by the other user."
-                )
-            except:
-                pass
-        save_data(data)
+        async with transaction(uid, users=(conversation_partner,)):
+            repo.set_user(uid, 'anon_conversation', None)
+            partner_data = repo.user(conversation_partner)
+            if partner_data and partner_data.get('anon_conversation') == uid:
+                repo.set_user(conversation_partner, 'anon_conversation', None)
+        if partner_data:
+            await notify(
+                context.bot.send_message,
+                conversation_partner,
+                "💭 Anonymous conversation ended by the other user."
+            )
         await update.message.reply_text("✅ Anonymous conversation ended.")
     else:
         await update.message.reply_text("❌ You are not in an anonymous conversation.")
@@ -1880,7 +4367,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • Send a photo to upload
 /delete - Delete your uploaded posts
 /saved - View your saved posts
-/trending - See trending posts
+/trending [page] - See trending posts
 
 📊 **Social Features:**
 /leaderboard - View top users by XP
@@ -1894,6 +4381,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 /makeadmin <user_id> - Make someone admin (Main admin only)
 /reports - View reported posts (Admin only)
 /stats - View detailed bot statistics (Admin only)
+/broadcast <message> - Message every user; reply to a message to send it (Admin only)
 
 🛡️ **Admin Powers:**
 • Unlimited uploads and shuffles
@@ -1918,47 +4406,79 @@ Enjoy ShuffleGram! 🎉
 """
     await update.message.reply_text(help_text)
 
+# ===== STARTUP / SHUTDOWN =====
+async def on_startup(application: Application):
+    await repo.start()
+    settings_store.task = asyncio.create_task(settings_store.watch())
+    fanout.start(application.bot)
+    digests.start(application.bot)
+    broadcaster.load()
+    broadcaster.resume(application.bot)
+
+async def on_shutdown(application: Application):
+    if settings_store.task:
+        settings_store.task.cancel()
+    fanout.stop()
+    digests.stop()
+    broadcaster.stop()
+    await repo.close()
+
 # ===== MAIN FUNCTION =====
 def main():
+    if sys.argv[1:2] == ["--import-json"]:
+        import_json_to_sqlite(SQLITE_FILE)
+        return
+
     keep_alive()
 
     if not BOT_TOKEN:
         print("Error: BOT_TOKEN environment variable not set!")
         return
 
-    application = Application.builder().token(BOT_TOKEN).build()
+    repo.load()
+    settings_store.load()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .rate_limiter(OutboundScheduler())
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
+
+    # Refresh cached display names and revive dead recipients before the real handlers run
+    application.add_handler(TypeHandler(Update, user_seen), group=-1)
 
     # Commands
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("shuffle", shuffle))
-    application.add_handler(CommandHandler("profile", profile))
-    application.add_handler(CommandHandler("leaderboard", leaderboard))
-    application.add_handler(CommandHandler("delete", delete))
-    application.add_handler(CommandHandler("ban", ban))
-    application.add_handler(CommandHandler("unban", unban))
-    application.add_handler(CommandHandler("verify", verify))
-    application.add_handler(CommandHandler("makeadmin", make_admin))
-    application.add_handler(CommandHandler("trending", trending))
-    application.add_handler(CommandHandler("saved", view_saved))
-    application.add_handler(CommandHandler("comments", view_comments))
-    application.add_handler(CommandHandler("reports", view_reports))
-    application.add_handler(CommandHandler("stats", admin_stats))
-    application.add_handler(CommandHandler("adminpanel", admin_panel))
-    application.add_handler(CommandHandler("share", share))
-    application.add_handler(CommandHandler("stop", stop_anonymous_chat))
+    application.add_handler(CommandHandler("start", timed(per_user(start))))
+    application.add_handler(CommandHandler("help", timed(per_user(help_command))))
+    application.add_handler(CommandHandler("shuffle", timed(per_user(shuffle))))
+    application.add_handler(CommandHandler("profile", timed(per_user(profile))))
+    application.add_handler(CommandHandler("leaderboard", timed(per_user(leaderboard))))
+    application.add_handler(CommandHandler("delete", timed(per_user(delete))))
+    application.add_handler(CommandHandler("ban", timed(per_user(ban))))
+    application.add_handler(CommandHandler("unban", timed(per_user(unban))))
+    application.add_handler(CommandHandler("verify", timed(per_user(verify))))
+    application.add_handler(CommandHandler("makeadmin", timed(per_user(make_admin))))
+    application.add_handler(CommandHandler("trending", timed(per_user(trending))))
+    application.add_handler(CommandHandler("saved", timed(per_user(view_saved))))
+    application.add_handler(CommandHandler("comments", timed(per_user(view_comments))))
+    application.add_handler(CommandHandler("reports", timed(per_user(view_reports))))
+    application.add_handler(CommandHandler("stats", timed(per_user(admin_stats))))
+    application.add_handler(CommandHandler("broadcast", timed(per_user(broadcast))))
+    application.add_handler(CommandHandler("adminpanel", timed(per_user(admin_panel))))
+    application.add_handler(CommandHandler("share", timed(per_user(share))))
+    application.add_handler(CommandHandler("stop", timed(per_user(stop_anonymous_chat))))
 
     # Message + Callback handlers
-    application.add_handler(MessageHandler(filters.PHOTO, photo_handler))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, keyboard_handler))
-    application.add_handler(CallbackQueryHandler(delete_button_handler, pattern="^del\\|"))
-    application.add_handler(CallbackQueryHandler(button_handler))
+    application.add_handler(MessageHandler(filters.PHOTO, timed(per_user(photo_handler))))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, timed(per_user(keyboard_handler))))
+    application.add_handler(CallbackQueryHandler(timed(per_user(delete_button_handler)), pattern="^del\\|"))
+    application.add_handler(CallbackQueryHandler(timed(dedupe_callbacks(per_user(button_handler)))))
 
     print("🔥 ShuffleGram Bot Started!")
     application.run_polling()
 
 if __name__ == '__main__':
     main()
-if __name__ == "__main__":
-    keep_alive()
-    application.run_polling()
\ No newline at end of file